@@ -0,0 +1,353 @@
+import os
+import sys
+import time
+import uuid
+import random
+import fnmatch
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+
+from oel1 import DirNode, FileNode, FileSystem
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = build()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tree, current, elapsed
+
+def bench_node_memory(count=100000, per_dir=1000):
+    # Namespace of `count` files spread over directories of `per_dir` entries each
+    def build_dicts():
+        root = {"type": "directory", "contents": {}, "created": str(datetime.now())}
+        for d in range(count // per_dir):
+            directory = {"type": "directory", "contents": {}, "created": str(datetime.now())}
+            root["contents"][f"dir{d}"] = directory
+            for f in range(per_dir):
+                directory["contents"][f"file{f}.txt"] = {
+                    "type": "file",
+                    "size": 0,
+                    "created": str(datetime.now()),
+                    "data_id": str(uuid.uuid4())
+                }
+        return root
+
+    def build_nodes():
+        inode = 1
+        root = DirNode(inode, time.time())
+        for d in range(count // per_dir):
+            inode += 1
+            directory = DirNode(inode, time.time())
+            root.contents[sys.intern(f"dir{d}")] = directory
+            for f in range(per_dir):
+                inode += 1
+                directory.contents[sys.intern(f"file{f}.txt")] = FileNode(inode, time.time())
+        return root
+
+    print(f"Namespace memory, {count} files:")
+    for label, build in (("dict nodes", build_dicts), ("slots nodes", build_nodes)):
+        tree, current, elapsed = measure(build)
+        print(f"  {label:<12} {current / 1024 / 1024:8.1f} MiB  {current / count:6.0f} B/file  built in {elapsed:.2f}s")
+        del tree
+
+def bench_dedup(count=2000, templates=20, size=16384):
+    # `count` files, each a copy of one of `templates` documents with a short unique trailer
+    random.seed(0)
+    docs = [bytes(random.getrandbits(8) for _ in range(size)) for _ in range(templates)]
+    print(f"Dedup, {count} files from {templates} templates of {size} bytes:")
+    for dedup in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            # No checkpoints during the run, so only the write path itself is timed
+            fs = FileSystem(os.path.join(tmp, "bench.dat"), journal_limit=1 << 40, dedup=dedup,
+                            durability="batch", batch_size=None)
+            start = time.perf_counter()
+            with fs.batch():
+                for i in range(count):
+                    handle, _ = fs.open(f"/file{i}", "wb")
+                    handle.write_to_file(docs[i % templates] + f"#{i}\n".encode())
+            elapsed = time.perf_counter() - start
+            logical, physical = fs.memory_map.usage()
+            fs.journal.close()
+        label = "dedup" if dedup else "plain"
+        print(f"  {label:<6} logical {logical / 1024 / 1024:6.1f} MiB  physical {physical / 1024 / 1024:6.1f} MiB  "
+              f"ratio {logical / physical:5.2f}x  write {count * size / elapsed / 1024 / 1024:6.1f} MiB/s")
+
+def sample_text(size):
+    # Log-style text: timestamps, levels and a small vocabulary, like our typical files
+    words = ["request", "user", "session", "cache", "miss", "hit", "timeout", "retry", "ok", "error", "GET", "POST"]
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2024-01-{random.randint(1, 28):02d} {random.randint(0, 23):02d}:{random.randint(0, 59):02d}:"
+                f"{random.randint(0, 59):02d} {random.choice(['INFO', 'WARN', 'DEBUG'])} "
+                + " ".join(random.choice(words) for _ in range(random.randint(3, 10)))
+                + f" id={random.getrandbits(32):08x}\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines)[:size]
+
+def bench_compression(count=200, size=65536, reads=2000):
+    random.seed(0)
+    docs = [sample_text(size) for _ in range(count)]
+    print(f"Compression, {count} text files of {size} bytes:")
+    for codec in (None, "zlib", "lzma", "bz2"):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.dat")
+            fs = FileSystem(path, journal_limit=1 << 40, durability="batch", batch_size=None,
+                            image_format="binary", compression=codec)
+            start = time.perf_counter()
+            with fs.batch():
+                for i, doc in enumerate(docs):
+                    handle, _ = fs.open(f"/file{i}", "w")
+                    handle.write_to_file(doc)
+            write_time = time.perf_counter() - start
+            handles = [fs.open(f"/file{i}", "r")[0] for i in range(count)]
+            start = time.perf_counter()
+            for handle in handles:
+                handle.read_from_file()
+            read_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(reads):
+                random.choice(handles).read_from_file(random.randrange(size), 100)
+            small_time = time.perf_counter() - start
+            logical, physical = fs.memory_map.usage()
+            fs.checkpoint()
+            image_size = os.path.getsize(path)
+            fs.journal.close()
+            fs.unmap_image()
+        mib = count * size / 1024 / 1024
+        print(f"  {codec or 'none':<5} memory {physical / 1024 / 1024:6.2f} MiB  image {image_size / 1024 / 1024:6.2f} MiB  "
+              f"ratio {logical / physical:5.2f}x  write {mib / write_time:7.1f} MiB/s  read {mib / read_time:7.1f} MiB/s  "
+              f"100-byte read {small_time / reads * 1e6:6.1f} us")
+
+def bench_find(count=1000000, per_dir=1000, repeat=5):
+    # Name index lookups vs. a naive walk over a namespace of `count` files
+    with tempfile.TemporaryDirectory() as tmp:
+        fs = FileSystem(os.path.join(tmp, "bench.dat"), journal_limit=1 << 40, durability="batch", batch_size=None)
+        start = time.perf_counter()
+        with fs.batch():
+            for d in range(count // per_dir):
+                fs.mkdir(f"/dir{d}")
+                for f in range(per_dir):
+                    i = d * per_dir + f
+                    fs.create(f"/dir{d}/file{i}.{'log' if i % 10 == 0 else 'txt'}")
+        print(f"Find over {count} files (built in {time.perf_counter() - start:.1f}s):")
+
+        def naive(pattern):
+            return sorted(os.path.join(path, name) for path, dirnames, filenames in fs.walk("/")
+                          for name in dirnames + filenames if fnmatch.fnmatchcase(name, pattern))
+
+        target = count // 2
+        for label, pattern in (("exact", f"file{target}.log"), ("prefix", f"file{target // 100}*"),
+                               ("suffix", "*.log")):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found = fs.find(pattern)
+            indexed = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            expected = naive(pattern)
+            walked = time.perf_counter() - start
+            assert found == expected
+            print(f"  {label:<7} {pattern:<18} {len(found):>7} hits  index {indexed * 1000:9.3f} ms  "
+                  f"walk {walked * 1000:9.1f} ms")
+        fs.journal.close()
+
+def bench_provision(tenants=200, dirs=5, files=10):
+    # Tenant trees of `dirs` directories holding `files` small files each, created op by op
+    # (default immediate durability) vs. one apply() per tenant
+    print(f"Provisioning {tenants} tenants of {dirs * files} files:")
+    for label in ("single", "apply"):
+        with tempfile.TemporaryDirectory() as tmp:
+            fs = FileSystem(os.path.join(tmp, "bench.dat"), journal_limit=1 << 40)
+            start = time.perf_counter()
+            for t in range(tenants):
+                ops = [("mkdir", f"/tenant{t}")]
+                for d in range(dirs):
+                    ops.append(("mkdir", f"/tenant{t}/dir{d}"))
+                    for f in range(files):
+                        ops.append(("write", f"/tenant{t}/dir{d}/file{f}.cfg", f"tenant={t} dir={d} file={f}\n"))
+                if label == "apply":
+                    fs.apply(ops)
+                    continue
+                for op in ops:
+                    if op[0] == "mkdir":
+                        fs.mkdir(op[1])
+                    else:
+                        handle, _ = fs.open(op[1], "w")
+                        handle.write_to_file(op[2])
+                        fs.close(handle)
+            elapsed = time.perf_counter() - start
+            journal_size = fs.journal.size
+            fs.journal.close()
+        ops_count = tenants * (1 + dirs + dirs * files)
+        print(f"  {label:<6} {ops_count / elapsed:9.0f} ops/s  journal {journal_size / 1024:7.0f} KiB")
+
+def bench_import(count=20000, per_dir=500, size=2048, large=4, large_size=32 << 20):
+    # Host tree of `count` small files plus a few large ones: a per-file loop as scripts do it
+    # today vs. import_tree with one and with eight workers, then export_tree back out
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        host = os.path.join(tmp, "host")
+        for i in range(count):
+            directory = os.path.join(host, f"dir{i // per_dir}")
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"file{i}.txt"), "w") as f:
+                f.write(sample_text(size))
+        for i in range(large):
+            with open(os.path.join(host, f"large{i}.bin"), "wb") as f:
+                f.write(os.urandom(large_size))
+        total = (count * size + large * large_size) / 1024 / 1024
+        print(f"Import of {count} files + {large} x {large_size >> 20} MiB ({total:.0f} MiB):")
+        for label in ("per-file", "1 worker", "8 workers"):
+            fs = FileSystem(os.path.join(tmp, f"{label}.dat"), journal_limit=1 << 40)
+            start = time.perf_counter()
+            if label == "per-file":
+                for root, dirnames, filenames in os.walk(host):
+                    target = "/" + os.path.relpath(root, host).replace(os.sep, "/").lstrip(".")
+                    if target != "/":
+                        fs.mkdir(target)
+                    for name in filenames:
+                        with open(os.path.join(root, name), "rb") as f:
+                            handle, _ = fs.open(f"{target.rstrip('/')}/{name}", "wb")
+                            handle.write_to_file(f.read())
+                            fs.close(handle)
+            else:
+                fs.import_tree(host, "/", workers=1 if label == "1 worker" else 8)
+            elapsed = time.perf_counter() - start
+            print(f"  import {label:<9} {count / elapsed:8.0f} files/s {total / elapsed:7.1f} MiB/s")
+            if label != "per-file":
+                start = time.perf_counter()
+                fs.export_tree("/", os.path.join(tmp, f"out {label}"), workers=1 if label == "1 worker" else 8)
+                elapsed = time.perf_counter() - start
+                print(f"  export {label:<9} {count / elapsed:8.0f} files/s {total / elapsed:7.1f} MiB/s")
+            fs.journal.close()
+
+def bench_checkpoint(counts=(10000, 100000, 300000), per_dir=1000):
+    # Background checkpoint of a namespace of `count` files: how long the capture holds the
+    # exclusive lock, and the slowest of the creates issued every millisecond while it is written
+    print("Background checkpoint:")
+    for count in counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            fs = FileSystem(os.path.join(tmp, "bench.dat"), journal_limit=1 << 40, image_format="binary",
+                            durability="batch", batch_size=None)
+            with fs.batch():
+                for d in range(count // per_dir):
+                    fs.mkdir(f"/dir{d}")
+                    for f in range(per_dir):
+                        fs.create(f"/dir{d}/file{f}.txt")
+            start = time.perf_counter()
+            fs.checkpoint(background=True)
+            stall = time.perf_counter() - start
+            latencies = []
+            while fs.snapshot_thread is not None:
+                start = time.perf_counter()
+                fs.create(f"/dir0/new{len(latencies)}")
+                latencies.append(time.perf_counter() - start)
+                time.sleep(0.001)
+            print(f"  {count:>7} files  capture {stall * 1000:8.2f} ms  "
+                  f"{len(latencies):6} creates meanwhile, slowest {max(latencies, default=0) * 1000:7.2f} ms")
+            fs.journal.close()
+
+def bench_stress(threads=8, ops=2000, seed=0):
+    # Threads mixing create/append/move with background checkpoints and flushes under interval
+    # durability; every thread checks its own files against a model as it goes, and the final
+    # tree must match both the models and a fresh load of the image and journal
+    def snapshot(fs):
+        state = {}
+        for path, dirnames, filenames in fs.walk("/"):
+            for name in filenames:
+                full = f"{path.rstrip('/')}/{name}"
+                handle, _ = fs.open(full, "rb")
+                state[full] = handle.read_from_file()
+                fs.close(handle)
+        return state
+
+    print(f"Stress, {threads} threads x {ops} ops:")
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "bench.dat")
+        fs = FileSystem(image, journal_limit=64 << 10, durability="interval", flush_interval=5)
+        fs.mkdir("/shared")
+        models = [{} for _ in range(threads)]
+        errors = []
+
+        def worker(t):
+            rng = random.Random(seed + t)
+            model = models[t]
+            home = f"/t{t}"
+            fs.mkdir(home)
+            try:
+                for i in range(ops):
+                    roll = rng.random()
+                    if roll < 0.2 or not model:
+                        path = f"{home}/f{i}"
+                        assert fs.create(path) == f"File {path} created", path
+                        model[path] = b""
+                    elif roll < 0.7:
+                        path = rng.choice(list(model))
+                        data = f"{t}:{i};".encode() * rng.randint(1, 50)
+                        handle, _ = fs.open(path, "ab")
+                        assert handle.write_to_file(data) == "Write successful", path
+                        fs.close(handle)
+                        model[path] += data
+                    elif roll < 0.85:
+                        path = rng.choice(list(model))
+                        target = f"/shared/t{t}-{i}" if rng.random() < 0.5 else f"{home}/m{i}"
+                        assert fs.move(path, target) == f"Moved {path} to {target}", path
+                        model[target] = model.pop(path)
+                    elif roll < 0.9:
+                        fs.checkpoint(background=True)
+                    else:
+                        fs.flush()
+                    if i % 100 == 0:
+                        path = rng.choice(list(model))
+                        handle, _ = fs.open(path, "rb")
+                        assert handle.read_from_file() == model[path], path
+                        fs.close(handle)
+            except Exception as exc:
+                errors.append(f"thread {t}: {exc!r}")
+
+        # Failures in the flush timer or a background checkpoint count too
+        default_hook = threading.excepthook
+        threading.excepthook = lambda args: errors.append(f"{args.thread.name}: {args.exc_value!r}")
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if fs.snapshot_thread is not None:
+            fs.snapshot_thread.join()
+        fs.flush()
+        elapsed = time.perf_counter() - start
+        threading.excepthook = default_hook
+        live = snapshot(fs)
+        fs.journal.close()
+        reloaded = snapshot(FileSystem(image))
+        expected = {path: data for model in models for path, data in model.items()}
+        problems = errors + [f"{label} differs from the models" for label, state in
+                             (("live tree", live), ("reloaded tree", reloaded)) if state != expected]
+        print(f"  {threads * ops / elapsed:9.0f} ops/s  {len(expected)} files  "
+              + ("consistent" if not problems else "FAILED"))
+        for problem in problems:
+            print(f"  {problem}")
+        if problems:
+            sys.exit(1)
+
+BENCHMARKS = {
+    "nodes": bench_node_memory,
+    "dedup": bench_dedup,
+    "compression": bench_compression,
+    "find": bench_find,
+    "provision": bench_provision,
+    "import": bench_import,
+    "checkpoint": bench_checkpoint,
+    "stress": bench_stress,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,31 +1,1777 @@
 import os
+import sys
 import json
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+import codecs
+import mmap
+import hashlib
+import heapq
+import bisect
+import itertools
+import fnmatch
+import re
+import zlib
+import lzma
+import bz2
+import struct
+import stat
+import shlex
+import cmd
+import argparse
 from datetime import datetime
-import uuid
+import shutil
+import time
+import threading
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = [
+    "FileSystem", "FileObject", "AsyncFileSystem", "AsyncFileObject", "FileSystemShell", "FileSystemGUI",
+    "Rollback", "register_codec", "main",
+]
+
+# tkinter is imported on first use (load_tk) so headless tools start fast
+tk = ttk = messagebox = filedialog = None
+
+def load_tk():
+    global tk, ttk, messagebox, filedialog
+    import tkinter as tk
+    from tkinter import ttk, messagebox, filedialog
+
+IMAGE_MAGIC = b"FSIMG01\n"  # Binary image: magic, data region, metadata JSON, 8-byte metadata offset
+
+# Block compression codecs: name -> (compress, decompress), both bytes -> bytes
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = (compress, decompress)
+
+class RWLock:
+    # Shared/exclusive lock. The exclusive holder may re-enter either side and
+    # shared holders may re-enter the shared side, but a shared holder must never
+    # ask for the exclusive side. Waiting writers block new readers.
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.writers_waiting = 0
+        self.local = threading.local()
+
+    def owned(self):
+        return self.writer == threading.get_ident()
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth or self.owned():
+            self.local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.local.depth = depth
+            return
+        with self.cond:
+            while self.writer is not None or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        self.local.depth = 1
+        try:
+            yield
+        finally:
+            self.local.depth = 0
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_depth += 1
+            else:
+                self.writers_waiting += 1
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+                self.writers_waiting -= 1
+                self.writer = me
+                self.writer_depth = 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer_depth -= 1
+                if not self.writer_depth:
+                    self.writer = None
+                    self.cond.notify_all()
+
+def fsync_path(path):
+    # fsyncs a file or directory by name; directories make renames and new entries in them durable
+    if os.path.isdir(path) and os.name == "nt":
+        return  # Windows can't open directories, and its renames don't need this
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Journal:
+    # Append-only log of mutations kept next to the snapshot. Each record is a
+    # compact JSON header line optionally followed by a raw payload of "len" bytes.
+    def __init__(self, path):
+        self.path = path
+        self.old_path = path + ".old"  # Records set aside while a snapshot is being written
+        self.handle = None
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.old_unsynced = False  # Records moved aside by rotate() that were never fsynced
+
+    def append(self, header, payload=b"", flush=True):
+        # Without flush the record sits in the write buffer until the next flush or sync()
+        if payload:
+            header["len"] = len(payload)
+        line = json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n"
+        if self.handle is None:
+            self.handle = open(self.path, "ab")
+        self.handle.write(line + payload)
+        if flush:
+            self.handle.flush()
+        self.size += len(line) + len(payload)
+
+    def sync(self):
+        if self.handle is not None:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+        if self.old_unsynced:
+            fsync_path(self.old_path)
+            fsync_path(os.path.dirname(os.path.abspath(self.old_path)))  # The rename to .old
+            self.old_unsynced = False
+
+    def replay(self):
+        yield from self.replay_file(self.old_path)
+        yield from self.replay_file(self.path)
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def replay_file(self, path):
+        if not os.path.exists(path):
+            return
+        good = 0
+        with open(path, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    header = json.loads(line)
+                except ValueError:
+                    break
+                length = header.get("len", 0)
+                payload = f.read(length)
+                if len(payload) != length:
+                    break
+                good = f.tell()
+                yield header, payload
+        # Drop a torn record left behind by a crash so new appends start clean
+        if good < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good)
+
+    def rotate(self):
+        # Moves the current records aside; new records start a fresh journal. The caller
+        # serializes this with append() and sync() (FileSystem.journal_lock).
+        self.close()
+        if os.path.exists(self.path):
+            self.old_unsynced = True
+            if os.path.exists(self.old_path):
+                # An earlier snapshot never finished, so its records are still needed too
+                with open(self.old_path, "ab") as dst, open(self.path, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+        self.size = 0
+
+    def drop_old(self):
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+        self.old_unsynced = False
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+def format_time(timestamp):
+    return str(datetime.fromtimestamp(timestamp))
+
+def parse_time(value):
+    # Accepts both numeric timestamps and the str(datetime) values older images stored
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return time.time()
+
+class DirNode:
+    # Namespace entries use __slots__ classes with integer inodes and numeric timestamps;
+    # the on-disk JSON keeps the original dict layout (see to_json / FileSystem.node_from_json).
+    # Directories also carry aggregates over their whole subtree, kept up to date through
+    # parent pointers (see FileSystem.add_totals) and rebuilt on load rather than persisted.
+    __slots__ = ("inode", "created", "contents", "parent", "total_bytes", "total_files", "total_dirs", "quota")
+    type = "directory"
+
+    def __init__(self, inode, created):
+        self.inode = inode
+        self.created = created
+        self.contents = {}  # Interned name -> node
+        self.parent = None
+        self.total_bytes = 0
+        self.total_files = 0
+        self.total_dirs = 0
+        self.quota = None  # [max_bytes, max_inodes] for the subtree (either may be None), persisted
+
+    def totals(self):
+        # (bytes, files, directories) this node contributes to its ancestors' aggregates
+        return self.total_bytes, self.total_files, self.total_dirs + 1
+
+    def to_json(self, quota):
+        # Everything but "contents", which FileSystem.snapshot_json adds; quota as captured by the snapshot
+        info = {
+            "type": "directory",
+            "created": format_time(self.created),
+            "inode": self.inode
+        }
+        if quota is not None:
+            info["quota"] = quota
+        return info
+
+class FileNode:
+    __slots__ = ("inode", "created", "size")
+    type = "file"
+
+    def __init__(self, inode, created, size=0):
+        self.inode = inode  # Also the data_id of the file's content in the block store
+        self.created = created
+        self.size = size
+
+    def totals(self):
+        return self.size, 1, 0
+
+    def to_json(self, size):
+        return {"type": "file", "size": size, "created": format_time(self.created), "data_id": str(self.inode)}
+
+class DirEntry:
+    # Directory entry yielded by FileSystem.scandir, in the spirit of os.DirEntry
+    __slots__ = ("name", "path", "type", "size", "created", "inode")
+
+    def __init__(self, name, path, node):
+        self.name = name
+        self.path = path
+        self.type = node.type
+        self.size = node.size if node.type == "file" else node.total_bytes
+        self.created = node.created
+        self.inode = node.inode
+
+    def is_dir(self):
+        return self.type == "directory"
+
+    def is_file(self):
+        return self.type == "file"
+
+    def __repr__(self):
+        return f"<DirEntry {self.name!r}>"
+
+class PackedBlock:
+    # A compressed block. Blocks are stored as plain bytes or as a PackedBlock, which is
+    # only inflated (see unpack) when the range being read or written covers it.
+    __slots__ = ("codec", "data")
+
+    def __init__(self, codec, data):
+        self.codec = codec
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, PackedBlock) and other.codec == self.codec and other.data == self.data
+
+def unpack(block):
+    return block if type(block) is bytes else CODECS[block.codec][1](block.data)
+
+def packed_blocks(view, layout):
+    # The blocks of a file saved compressed, from its extent in an image
+    pos = 0
+    for codec, size in layout:
+        stored = bytes(view[pos:pos + size])
+        yield stored if codec is None else PackedBlock(codec, stored)
+        pos += size
+
+CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+def count_chars(data):
+    # Characters in UTF-8 data, counted by their first byte: continuation bytes are skipped
+    return len(data.translate(None, CONTINUATION_BYTES))
+
+class CharCounts:
+    # Characters per block of a non-ASCII file (a character belongs to the block holding its
+    # first byte). The running totals are only recomputed from the first block changed since.
+    __slots__ = ("counts", "sums", "valid")
+
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.sums = []
+        self.valid = 0  # Leading entries of sums still correct
+
+    def set(self, index, count):
+        if index < len(self.counts):
+            self.counts[index] = count
+        else:
+            self.counts.append(count)
+        self.valid = min(self.valid, index)
+
+    def truncate(self, keep):
+        del self.counts[keep:]
+        self.valid = min(self.valid, keep)
+
+    def totals(self):
+        # Characters in blocks 0..i, for each block i
+        if self.valid < len(self.counts) or len(self.sums) > len(self.counts):
+            base = self.sums[self.valid - 1] if self.valid else 0
+            del self.sums[self.valid:]
+            self.sums.extend(itertools.accumulate(self.counts[self.valid:], initial=base))
+            del self.sums[self.valid]  # The initial value
+            self.valid = len(self.counts)
+        return self.sums
+
+def format_block_runs(blocks):
+    # Collapses consecutive block numbers into ranges, e.g. [0, 1, 2, 7] -> "0-2, 7"
+    runs = []
+    for block in blocks:
+        if runs and block == runs[-1][1] + 1:
+            runs[-1][1] = block
+        else:
+            runs.append([block, block])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in runs)
+
+class BlockStore:
+    # Fixed-size block engine over bytes. Each file holds an ordered list of block numbers;
+    # released blocks go on a free list and are reused before the pool grows. Blocks are
+    # refcounted: a block referenced by more than one file is copied on write. With dedup
+    # enabled, blocks are content-addressed so identical blocks are stored only once.
+    # With a compression codec, full blocks of files of at least compress_threshold bytes
+    # are stored compressed; the partial last block stays plain so appends don't recompress it.
+    def __init__(self, block_size=4096, dedup=False, compression=None, compress_threshold=4096):
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"Unknown compression codec: {compression}")
+        self.block_size = block_size
+        self.dedup = dedup
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.blocks = []  # Block number -> content (immutable bytes or PackedBlock, replaced on write)
+        # Block number -> data_id of a file holding it: the one that stored it first until that file
+        # lets go of it, then found again on demand (see owner). None for free blocks.
+        self.owners = []
+        self.refs = []  # Block number -> number of file block-list entries referencing it
+        self.chunks = {}  # Digest -> block number (dedup mode)
+        self.digests = {}  # Block number -> digest of its content (dedup mode)
+        self.free = []  # Released block numbers
+        self.files = {}  # data_id -> list of block numbers
+        self.lengths = {}  # data_id -> content length in bytes
+        self.ascii = {}  # data_id -> True while the content is pure ASCII (byte offsets == character offsets)
+        self.mapped = {}  # data_id -> memoryview into the image, for files not yet loaded into blocks
+        self.layouts = {}  # data_id -> [codec, stored size] per block, for mapped files saved compressed
+        self.chars = {}  # data_id -> CharCounts of a non-ASCII file (None for a mapped one until counted)
+        self.frozen = None  # While a snapshot is written: data_id -> capture() of files changed since
+        self.frozen_lock = threading.Lock()  # Orders preserve() against the snapshot reading a file
+        self.lock = threading.Lock()  # Guards the shared pool (blocks, owners, refs, chunk table, free list)
+
+    def __contains__(self, data_id):
+        return data_id in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def allocate(self, data_id):
+        self.files[data_id] = []
+        self.lengths[data_id] = 0
+        self.ascii[data_id] = True
+
+    def map_extent(self, data_id, view, ascii, layout=None, chars=None):
+        # A compressed file (with a layout) is served from the map too, and only split into
+        # blocks when it is first read or modified. chars: its saved character counts, if not ASCII.
+        self.files[data_id] = []
+        self.lengths[data_id] = len(view) if layout is None else sum(
+            size if codec is None else self.block_size for codec, size in layout)
+        self.ascii[data_id] = ascii
+        self.mapped[data_id] = view
+        if layout is not None:
+            self.layouts[data_id] = layout
+        if not ascii:
+            self.chars[data_id] = None if chars is None else CharCounts(chars)
+
+    def unmap(self):
+        # Detaches every mapped view so the image can be closed; returns the affected data_ids
+        data_ids = list(self.mapped)
+        for view in self.mapped.values():
+            view.release()
+        self.mapped.clear()
+        return data_ids
+
+    def clone(self, data_id, new_id):
+        # The copy shares every block with the original; whichever side writes a shared block first copies it
+        self.lengths[new_id] = self.lengths[data_id]
+        self.ascii[new_id] = self.ascii[data_id]
+        if data_id in self.chars:
+            counts = self.chars[data_id]
+            self.chars[new_id] = None if counts is None else CharCounts(counts.counts)
+        view = self.mapped.get(data_id)
+        if view is not None:
+            self.files[new_id] = []
+            self.mapped[new_id] = view[:]
+            if data_id in self.layouts:
+                self.layouts[new_id] = self.layouts[data_id]
+            return
+        with self.lock:
+            for block in self.files[data_id]:
+                self.refs[block] += 1
+        self.files[new_id] = list(self.files[data_id])
+
+    def materialize(self, data_id):
+        # Copies a mapped file into blocks, the first time it is modified (or, if it was saved
+        # compressed, read: its blocks stay compressed until a read covers them)
+        if data_id not in self.mapped:
+            return
+        self.preserve(data_id)
+        view = self.mapped.pop(data_id)
+        layout = self.layouts.pop(data_id, None)
+        if layout is None:
+            bs = self.block_size
+            for offset in range(0, len(view), bs):
+                self.put(data_id, offset // bs, bytes(view[offset:offset + bs]))
+        else:
+            for index, block in enumerate(packed_blocks(view, layout)):
+                self.place(data_id, index, block)
+        view.release()
+
+    def capture(self, data_id):
+        # (blocks, view, ascii, layout, character counts, length) of the file as it is now. Blocks are
+        # immutable (writes replace them), so they are shared with the store instead of copied.
+        view = self.mapped.get(data_id)
+        counts = self.chars.get(data_id)
+        blocks = None if view is not None else [self.blocks[block] for block in self.files[data_id]]
+        return (blocks, None if view is None else view[:], self.ascii[data_id], self.layouts.get(data_id),
+                None if counts is None else list(counts.counts), self.lengths[data_id])
+
+    def preserve(self, data_id):
+        # Called before the content of a file changes, so the snapshot being written still sees it
+        if self.frozen is not None:
+            with self.frozen_lock:
+                if data_id not in self.frozen:
+                    self.frozen[data_id] = self.capture(data_id)
+
+    def captured(self, data_id):
+        # capture() of the file as of the snapshot being written
+        with self.frozen_lock:
+            return self.frozen.get(data_id) or self.capture(data_id)
+
+    def release(self, data_id):
+        self.preserve(data_id)
+        view = self.mapped.pop(data_id, None)
+        if view is not None:
+            view.release()
+        self.layouts.pop(data_id, None)
+        self.chars.pop(data_id, None)
+        with self.lock:
+            for block in self.files.pop(data_id):
+                self.unref(block, data_id)
+        del self.lengths[data_id]
+        del self.ascii[data_id]
+
+    def put(self, data_id, index, content):
+        # Stores content as block `index` of the file (appending when index is one past the end)
+        counts = self.chars.get(data_id)
+        if counts is not None:
+            counts.set(index, count_chars(content))
+        if (self.compression and len(content) == self.block_size
+                and self.lengths[data_id] >= self.compress_threshold):
+            packed = CODECS[self.compression][0](content)
+            if len(packed) < len(content):
+                content = PackedBlock(self.compression, packed)
+        self.place(data_id, index, content)
+
+    def place(self, data_id, index, stored):
+        # An unshared block is updated in place unless blocks are content-addressed.
+        # Dedup compares blocks in their stored form, so compressed blocks are never inflated here.
+        blocks = self.files[data_id]
+        old = blocks[index] if index < len(blocks) else None
+        if old is not None and not self.dedup and self.refs[old] == 1:
+            self.blocks[old] = stored
+            return
+        digest = None
+        if self.dedup:
+            key = stored if type(stored) is bytes else stored.codec.encode() + b"\0" + stored.data
+            digest = hashlib.blake2b(key, digest_size=16).digest()
+        with self.lock:
+            if old is not None:
+                self.unref(old, data_id)
+            block = self.chunks.get(digest) if digest is not None else None
+            if block is not None and self.blocks[block] == stored:
+                self.refs[block] += 1
+            else:
+                block = self.new_block(data_id)
+                self.blocks[block] = stored
+                if digest is not None and digest not in self.chunks:
+                    self.chunks[digest] = block
+                    self.digests[block] = digest
+        if old is None:
+            blocks.append(block)
+        else:
+            blocks[index] = block
+
+    def new_block(self, data_id):
+        # Caller holds self.lock
+        if self.free:
+            block = self.free.pop()
+            self.owners[block] = data_id
+            self.refs[block] = 1
+            return block
+        self.blocks.append(b"")
+        self.owners.append(data_id)
+        self.refs.append(1)
+        return len(self.blocks) - 1
+
+    def unref(self, block, data_id):
+        # Caller holds self.lock; data_id drops one reference and the block is freed once nothing
+        # references it. If the owner lets go of a block other files still share, the owner is
+        # looked up again by the next owner() call.
+        self.refs[block] -= 1
+        if not self.refs[block]:
+            self.blocks[block] = b""
+            self.owners[block] = None
+            self.free.append(block)
+            digest = self.digests.pop(block, None)
+            if digest is not None:
+                del self.chunks[digest]
+        elif self.owners[block] == data_id:
+            self.owners[block] = None
+
+    def owner(self, block):
+        # data_id of a file holding the block, or None when it is free
+        with self.lock:
+            if not 0 <= block < len(self.owners) or not self.refs[block]:
+                return None
+            if self.owners[block] is None:
+                self.owners[block] = next(
+                    (data_id for data_id, blocks in self.files.items() if block in blocks), None)
+            return self.owners[block]
+
+    def usage(self):
+        # (logical, physical) bytes: content length summed over files vs. bytes actually held,
+        # counting shared blocks once (content still served from the image counts as physical)
+        logical = sum(self.lengths.values())
+        with self.lock:
+            physical = sum(len(block) if type(block) is bytes else len(block.data) for block in self.blocks)
+        physical += sum(len(view) for view in self.mapped.values())
+        return logical, physical
+
+    def length(self, data_id):
+        return self.lengths[data_id]
+
+    def is_ascii(self, data_id):
+        return self.ascii[data_id]
+
+    def char_counts(self, data_id):
+        # CharCounts of a non-ASCII file; a mapped file whose counts were not saved is counted once
+        counts = self.chars[data_id]
+        if counts is None:
+            bs = self.block_size
+            counts = self.chars[data_id] = CharCounts(
+                count_chars(self.read(data_id, start, bs)) for start in range(0, self.lengths[data_id], bs))
+        return counts
+
+    def char_length(self, data_id):
+        if self.ascii[data_id]:
+            return self.lengths[data_id]
+        totals = self.char_counts(data_id).totals()
+        return totals[-1] if totals else 0
+
+    def char_offset(self, data_id, chars):
+        # Byte offset where character number chars starts (the content length past the end).
+        # Only the block holding it is read.
+        length = self.lengths[data_id]
+        if self.ascii[data_id]:
+            return min(chars, length)
+        totals = self.char_counts(data_id).totals()
+        index = bisect.bisect_right(totals, chars)
+        if index == len(totals):
+            return length
+        skip = chars - (totals[index - 1] if index else 0)
+        bs = self.block_size
+        block = self.read(data_id, index * bs, bs)
+        # Binary search for the first byte at which the block holds more than skip characters
+        lo, hi = 0, len(block) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if count_chars(block[:mid + 1]) > skip:
+                hi = mid
+            else:
+                lo = mid + 1
+        return index * bs + lo
+
+    def read(self, data_id, start=0, size=None):
+        length = self.lengths[data_id]
+        end = length if size is None else min(length, start + size)
+        if start >= end:
+            return b""
+        view = self.mapped.get(data_id)
+        if view is not None:
+            if data_id not in self.layouts:
+                return bytes(view[start:end])  # Served straight from the map
+            self.materialize(data_id)
+        bs = self.block_size
+        blocks = self.files[data_id]
+        parts = []
+        for i in range(start // bs, (end - 1) // bs + 1):
+            base = i * bs
+            parts.append(unpack(self.blocks[blocks[i]])[max(start - base, 0):min(end - base, bs)])
+        return b"".join(parts)
+
+    def write(self, data_id, offset, data):
+        # Overwrites in place from offset (which must not be past the end), growing the file as needed
+        if not data:
+            return
+        self.preserve(data_id)
+        self.materialize(data_id)
+        bs = self.block_size
+        if self.ascii[data_id] and not data.isascii():
+            # Until now every byte was a character
+            self.ascii[data_id] = False
+            length = self.lengths[data_id]
+            self.chars[data_id] = CharCounts(min(bs, length - start) for start in range(0, length, bs))
+        blocks = self.files[data_id]
+        end = offset + len(data)
+        old_length = self.lengths[data_id]
+        self.lengths[data_id] = max(old_length, end)
+        pos = 0
+        for i in range(offset // bs, (end - 1) // bs + 1):
+            base = i * bs
+            lo = max(offset - base, 0)
+            hi = min(end - base, bs)
+            if hi - lo == bs:
+                content = data[pos:pos + bs]  # Whole block replaced, the old one is never inflated
+            else:
+                block = unpack(self.blocks[blocks[i]]) if i < len(blocks) else b""
+                content = block[:lo] + data[pos:pos + hi - lo] + block[hi:]
+            self.put(data_id, i, content)
+            pos += hi - lo
+        if self.compression and old_length < self.compress_threshold <= end:
+            # Blocks written while the file was below the threshold are compressed now
+            for i, block in enumerate(blocks):
+                if type(self.blocks[block]) is bytes and len(self.blocks[block]) == bs:
+                    self.put(data_id, i, self.blocks[block])
+
+    def splice(self, data_id, offset, cut, data):
+        # Replaces cut bytes at offset with data; everything after the splice point is rewritten
+        tail = self.read(data_id, offset + cut)
+        self.truncate(data_id, offset)
+        self.write(data_id, offset, data + tail)
+
+    def truncate(self, data_id, size):
+        if size >= self.lengths[data_id]:
+            return
+        self.preserve(data_id)
+        self.materialize(data_id)
+        bs = self.block_size
+        blocks = self.files[data_id]
+        keep = -(-size // bs)
+        with self.lock:
+            for block in blocks[keep:]:
+                self.unref(block, data_id)
+        del blocks[keep:]
+        if self.chars.get(data_id) is not None:
+            self.chars[data_id].truncate(keep)
+        if size % bs:
+            self.put(data_id, keep - 1, unpack(self.blocks[blocks[-1]])[:size % bs])
+        self.lengths[data_id] = size
+        if not size:
+            self.ascii[data_id] = True
+            self.chars.pop(data_id, None)
+
+class NameIndex:
+    # Name -> set of full paths of the entries with that name, for exact lookups. The distinct
+    # names are also kept sorted, split into blocks of up to 2 * load names located by bisecting
+    # each block's first name, so prefix lookups and inserts stay sublinear.
+    def __init__(self, load=1000):
+        self.load = load
+        self.paths = {}
+        self.blocks = []  # Sorted lists of names, in order
+        self.firsts = []  # First name of each block
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, name, path):
+        paths = self.paths.get(name)
+        if paths is not None:
+            paths.add(path)
+            return
+        self.paths[name] = {path}
+        if not self.blocks:
+            self.blocks.append([name])
+            self.firsts.append(name)
+            return
+        i = max(bisect.bisect_right(self.firsts, name) - 1, 0)
+        block = self.blocks[i]
+        bisect.insort(block, name)
+        self.firsts[i] = block[0]
+        if len(block) > 2 * self.load:
+            self.blocks[i:i + 1] = [block[:self.load], block[self.load:]]
+            self.firsts[i:i + 1] = [block[0], block[self.load]]
+
+    def discard(self, name, path):
+        paths = self.paths.get(name)
+        if paths is None:
+            return
+        paths.discard(path)
+        if paths:
+            return
+        del self.paths[name]
+        i = max(bisect.bisect_right(self.firsts, name) - 1, 0)
+        block = self.blocks[i]
+        del block[bisect.bisect_left(block, name)]
+        if block:
+            self.firsts[i] = block[0]
+        else:
+            del self.blocks[i]
+            del self.firsts[i]
+
+    def exact(self, name):
+        return self.paths.get(name, ())
+
+    def prefixed(self, prefix):
+        # Distinct names starting with prefix, in sorted order
+        i = max(bisect.bisect_right(self.firsts, prefix) - 1, 0)
+        for block in self.blocks[i:]:
+            for name in block[bisect.bisect_left(block, prefix):]:
+                if not name.startswith(prefix):
+                    return
+                yield name
+
+class TextIndex:
+    # Inverted index over file content: lowercased word -> data_ids containing it. Changed files
+    # are only queued by the writer; a worker thread re-tokenizes them, so writes don't slow down.
+    # Files are tokenized in chunks of chunk_size bytes, each read under the locks on its own, and
+    # a change only re-tokenizes the chunks around the byte range it touched.
+    chunk_size = 65536  # At least 4, the longest UTF-8 character
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.postings = {}  # Word -> set of data_ids
+        self.words = {}  # data_id -> {word: number of its chunks containing it}
+        self.chunks = {}  # data_id -> set of words starting in each chunk
+        self.pending = {}  # data_id -> (start, end) byte range changed since it was last indexed (end None: to EOF)
+        self.indexing = None  # data_id the worker is re-tokenizing
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def touch(self, data_id, start=0, end=None):
+        with self.cond:
+            if data_id in self.pending:
+                old_start, old_end = self.pending[data_id]
+                start = min(start, old_start)
+                end = None if end is None or old_end is None else max(end, old_end)
+            self.pending[data_id] = (start, end)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                data_id, (start, end) = self.pending.popitem()
+                self.indexing = data_id
+            update = self.tokenize(data_id, start, end)
+            with self.cond:
+                self.indexing = None
+                # Chunks changed meanwhile are queued again, so the result is applied either way
+                self.update(data_id, *update)
+
+    def read(self, data_id, start, size):
+        # (bytes, content length) under the locks, or (None, None) once the file is gone
+        fs = self.fs
+        with fs.lock.shared():
+            if data_id not in fs.memory_map:
+                return None, None
+            with fs.file_lock(data_id):
+                return fs.memory_map.read(data_id, start, size), fs.memory_map.length(data_id)
+
+    def tokenize(self, data_id, start, end):
+        # (first chunk, last chunk, word sets of those chunks, chunk count) for a changed range,
+        # or (None,) * 4 for a deleted file. The chunk before the range is redone too, as its last
+        # word may run into the range, and so is any chunk after it that starts mid-word.
+        size = self.chunk_size
+        data, length = self.read(data_id, 0, 0)
+        if length is None:
+            return None, None, None, None
+        count = -(-length // size)
+        known = len(self.chunks.get(data_id, ()))
+        first = max(0, min(start // size, known, count) - 1)
+        while first and self.starts_mid_word(data_id, first):
+            first -= 1
+        last = count - 1 if end is None or count != known else min(count - 1, end // size + 1)
+        sets = []
+        for index in range(first, last + 1):
+            words = self.chunk_words(data_id, index)
+            if words is None:
+                return None, None, None, None
+            sets.append(words)
+        return first, last, sets, count
+
+    def starts_mid_word(self, data_id, index):
+        # True when the character before chunk index is a word character
+        data, length = self.read(data_id, index * self.chunk_size - 4, 8)
+        if not data:
+            return False
+        skip = 0  # Continuation bytes of that character
+        while skip < 3 and 4 + skip < len(data) and 0x80 <= data[4 + skip] < 0xC0:
+            skip += 1
+        return WORD_RE.match(data[:4 + skip].decode("utf-8", "replace").lower()[-1:]) is not None
+
+    def chunk_words(self, data_id, index):
+        # Lowercased words starting in chunk index (a word belongs to the chunk holding its first
+        # character), reading past the chunk end to finish its last word. None if the file is gone.
+        size = self.chunk_size
+        start = index * size
+        data, length = self.read(data_id, start, size + 3)
+        if data is None:
+            return None
+        # Continuation bytes at either edge belong to the character started before them
+        lead = 0
+        while index and lead < min(3, len(data)) and 0x80 <= data[lead] < 0xC0:
+            lead += 1
+        cut = min(size, len(data))
+        while cut < len(data) and 0x80 <= data[cut] < 0xC0:
+            cut += 1
+        text = data[lead:cut].decode("utf-8", "replace").lower()
+        core = len(text)
+        pos = start + cut
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        while pos < length and text and WORD_RE.match(text[-1]):
+            more, length = self.read(data_id, pos, 256)
+            if not more:
+                break
+            pos += len(more)
+            piece = decoder.decode(more).lower()
+            text += piece
+            if piece and not WORD_RE.fullmatch(piece):
+                break  # The word ended within this piece
+        # Words from the end of the one carried over from the previous chunk up to the end of
+        # the one running past the core
+        begin = 0
+        if index and WORD_RE.match(text[:1]) and self.starts_mid_word(data_id, index):
+            match = NONWORD_RE.search(text)
+            begin = match.start() if match else len(text)
+        match = NONWORD_RE.search(text, core)
+        return set(WORD_RE.findall(text, begin, match.start() if match else len(text)))
+
+    def update(self, data_id, first, last, sets, count):
+        # Caller holds self.cond; replaces the word sets of chunks first..last (sets is None for a
+        # deleted file) and adjusts the postings of words that appeared or disappeared
+        chunks = self.chunks.pop(data_id, [])
+        counts = self.words.pop(data_id, {})
+        if sets is None:
+            removed, added, chunks = chunks, [], None
+        else:
+            tail = last + 1 if last < count - 1 else len(chunks)
+            removed, added = chunks[first:tail], sets
+            chunks = chunks[:first] + sets + chunks[tail:]
+        changed = set()
+        for words in removed:
+            for word in words:
+                counts[word] -= 1
+                changed.add(word)
+        for words in added:
+            for word in words:
+                counts[word] = counts.get(word, 0) + 1
+                changed.add(word)
+        for word in changed:
+            if counts[word]:
+                self.postings.setdefault(word, set()).add(data_id)
+            else:
+                del counts[word]
+                ids = self.postings.get(word)
+                if ids is not None:
+                    ids.discard(data_id)
+                    if not ids:
+                        del self.postings[word]
+        if chunks is not None:
+            self.chunks[data_id] = chunks
+            self.words[data_id] = counts
+
+    def candidates(self, words):
+        # data_ids that may contain all of words, including files not yet (re)indexed
+        with self.cond:
+            postings = sorted((self.postings.get(word, set()) for word in set(words)), key=len)
+            found = set(postings[0]).intersection(*postings[1:])
+            found.update(self.pending)
+            if self.indexing is not None:
+                found.add(self.indexing)
+            return found
+
+WORD_RE = re.compile(r"\w+")
+NONWORD_RE = re.compile(r"\W")
+
+def glob_regex(pattern):
+    # Translates a glob over full paths: * and ? stay within one path component,
+    # ** spans any number of them (and "**/" may match none)
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            parts.append("[" + ("^" + body[1:] if body.startswith("!") else body).replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("".join(parts) + r"\Z")
+
+class Rollback(Exception):
+    # Raised inside FileSystem.transaction() to undo it; the block exits quietly
+    pass
+
+def edit_file(fs, fName, mode, action):
+    file_obj, result = fs.open(fName, mode)
+    if file_obj is None:
+        return result
+    try:
+        return action(file_obj)
+    finally:
+        fs.close(file_obj)
+
+# Operations accepted by FileSystem.apply: name -> (min args, max args, run, success message).
+# An op succeeded when its result equals the success message formatted with its arguments.
+TRANSACTION_OPS = {
+    "create": (1, 1, lambda fs, path: fs.create(path), "File {0} created"),
+    "mkdir": (1, 1, lambda fs, path: fs.mkdir(path), "Directory {0} created"),
+    "delete": (1, 1, lambda fs, path: fs.delete(path), "{0} deleted"),
+    "rmtree": (1, 1, lambda fs, path: fs.rmtree(path), "Directory {0} removed"),
+    "move": (2, 2, lambda fs, src, dst: fs.move(src, dst), "Moved {0} to {1}"),
+    "copy": (2, 2, lambda fs, src, dst: fs.copy_tree(src, dst), "Copied {0} to {1}"),
+    "quota": (1, 3, lambda fs, path, *limits: fs.set_quota(path, *limits), "Quota on {0} updated"),
+    # Content is str or bytes-like; "write" replaces it (or overwrites at write_at), "append" adds to it
+    "write": (2, 3, lambda fs, path, data, write_at=None: edit_file(
+        fs, path, "w" if isinstance(data, str) else "wb", lambda f: f.write_to_file(data, write_at)),
+        "Write successful"),
+    "append": (2, 2, lambda fs, path, data: edit_file(
+        fs, path, "a" if isinstance(data, str) else "ab", lambda f: f.write_to_file(data)),
+        "Write successful"),
+    # Opened with "r" so a missing file is reported instead of created (truncate ignores the mode)
+    "truncate": (2, 2, lambda fs, path, size: edit_file(fs, path, "r", lambda f: f.truncate_file(size)),
+                 "Truncate successful"),
+}
 
 class FileSystem:
-    def __init__(self, data_file="sample.dat"):
+    def __init__(self, data_file="sample.dat", journal_limit=1024 * 1024, block_size=4096, image_format=None,
+                 dir_cache_size=4096, durability="immediate", flush_interval=1000, batch_size=100, dedup=False,
+                 compression=None, compress_threshold=4096, capacity=None):
         self.data_file = data_file
+        # "binary" (also used for None) or "json". Either kind of image loads; a checkpoint writes this
+        # format, so an existing JSON image is rewritten as binary unless "json" is asked for.
+        self.image_format = image_format or "binary"
+        self.image_map = None  # mmap of a binary image, content is read from it on demand
+        self.image_view = None
         self.current_dir = "/"
-        self.fs_structure = {
-            "/": {"type": "directory", "contents": {}, "created": str(datetime.now())}
-        }
-        self.open_files = {}  # Tracks open file objects
-        self.memory_map = {}  # Tracks file data blocks
+        self.next_inode = 1
+        self.legacy_ids = {}  # uuid data_ids from older images -> inode numbers
+        self.fs_structure = {"/": DirNode(self.new_inode(), time.time())}
+        self.open_files = {}  # File descriptor -> open FileObject, in the order they were opened
+        self.open_counts = {}  # data_id -> number of open handles on it
+        self.next_fd = 3  # 0-2 are left out so descriptors never look like stdio
+        self.dedup = dedup  # Store identical content blocks once (see BlockStore)
+        self.compression = compression  # Codec name from CODECS, or None to store blocks uncompressed
+        self.compress_threshold = compress_threshold
+        self.capacity = capacity  # Limit on total content bytes, or None for no limit
+        self.memory_map = self.new_block_store(block_size)  # Tracks file data blocks
+        self.dir_cache = OrderedDict()  # LRU of resolved directory paths -> directory nodes
+        self.dir_cache_size = dir_cache_size
+        self.data_paths = {}  # Reverse index: data_id -> full path of the file holding it
+        self.names = NameIndex()  # Entry name -> full paths, for find/glob
+        self.text_index = None  # Inverted index over file content, built by the first search()
+        # Locking: namespace operations and checkpoints hold self.lock exclusively; content
+        # operations hold it shared plus the file's own lock, so a snapshot never sees a half-done op.
+        self.lock = RWLock()
+        self.file_locks = {}  # data_id -> lock serializing content operations on that file
+        self.file_locks_guard = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.totals_lock = threading.Lock()  # Guards directory aggregates, updated by concurrent content ops
+        self.journal_lock = threading.Lock()
+        self.checkpoint_due = False
+        self.snapshot_thread = None  # Background checkpoint in flight, if any
+        self.frozen = None  # While a snapshot is written: directory -> (contents, quota) before it changed
+        self.frozen_lock = threading.Lock()  # Orders preserve() against the snapshot reading a directory
+        self.journal = Journal(data_file + ".journal")
+        self.journal_limit = journal_limit  # Minimum journal size (bytes) before a checkpoint
+        self.journal_seq = 0  # Sequence number of the last logged mutation
+        self.snapshot_size = 0
+        self.unflushed = 0  # Records logged since the last flush
+        self.last_flush = time.monotonic()
+        self.flush_timer = None
+        self.batch_state = threading.local()  # Per thread: nesting depth of its batch() blocks
+        self.txn_records = None  # Records of the open transaction, logged together when it commits
+        self.set_durability(durability, flush_interval, batch_size)
         self.load_data()
 
-    def save_data(self):
-        with open(self.data_file, 'w') as f:
-            json.dump({"structure": self.fs_structure, "memory_map": self.memory_map}, f)
+    def set_durability(self, durability, flush_interval=None, batch_size=None):
+        # "immediate": every record reaches the OS as it is logged (the original behaviour)
+        # "interval": records are flushed at most every flush_interval ms
+        # "batch": records are flushed every batch_size ops (None: only on flush/close)
+        if durability not in ("immediate", "interval", "batch"):
+            raise ValueError(f"Unknown durability policy: {durability}")
+        self.durability = durability
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+    @property
+    def batch_depth(self):
+        # Only the calling thread's own batch() blocks defer its flushes and checkpoints
+        return getattr(self.batch_state, "depth", 0)
+
+    def new_block_store(self, block_size):
+        return BlockStore(block_size, self.dedup, self.compression, self.compress_threshold)
+
+    def capture_snapshot(self):
+        # Point-in-time view, taken under the exclusive lock without copying anything: from now on
+        # until it is installed, directories and file contents keep their state from before their
+        # first change (see preserve), and write_snapshot reads that instead of the live one
+        self.frozen = {}
+        self.memory_map.frozen = {}
+        return {
+            "root": self.fs_structure["/"],
+            "store": self.memory_map,
+            "frozen": self.frozen,
+            "journal_seq": self.journal_seq,
+            "next_inode": self.next_inode,
+            "block_size": self.memory_map.block_size,
+            "format": self.image_format,
+            # Filled in by write_snapshot: data_id -> (blocks, view, ascii), and for the files that
+            # have them, their layout (mapped files are saved as they are, compressed or not) and
+            # character counts
+            "files": {},
+            "layouts": {},
+            "chars": {}
+        }
+
+    def preserve(self, directory):
+        # Called with the exclusive lock held before directory's entries or quota change
+        if self.frozen is not None:
+            with self.frozen_lock:
+                if directory not in self.frozen:
+                    self.frozen[directory] = (dict(directory.contents), directory.quota)
+
+    def thaw(self):
+        # Exclusive lock held: the snapshot is done with the preserved state
+        if self.memory_map.frozen is not None:
+            for state in self.memory_map.frozen.values():
+                if state[1] is not None:
+                    state[1].release()
+        self.frozen = self.memory_map.frozen = None
+
+    def snapshot_json(self, directory, snapshot):
+        # JSON text of directory as captured, filling in snapshot["files"] for the files under it.
+        # Whatever changed since was preserved first, so anything not preserved is still as captured.
+        # Takes no lock but frozen_lock, which a change can't get past before preserving. Entries
+        # are encoded a run of files at a time, so writers never wait long for the GIL meanwhile.
+        store = snapshot["store"]
+        with self.frozen_lock:
+            contents, quota = snapshot["frozen"].get(directory) or (dict(directory.contents), directory.quota)
+        parts = []
+        run = {}
+        for name, child in contents.items():
+            if child.type == "file":
+                blocks, view, ascii, layout, chars, length = store.captured(child.inode)
+                snapshot["files"][child.inode] = (blocks, view, ascii)
+                if layout is not None:
+                    snapshot["layouts"][child.inode] = layout
+                if chars is not None:
+                    snapshot["chars"][child.inode] = chars
+                run[name] = child.to_json(length)
+                if len(run) < 1000:
+                    continue
+            if run:
+                parts.append(json.dumps(run)[1:-1])
+                run = {}
+            if child.type == "directory":
+                parts.append(json.dumps(name) + ": " + self.snapshot_json(child, snapshot))
+        if run:
+            parts.append(json.dumps(run)[1:-1])
+        return '{"contents": {' + ", ".join(parts) + "}, " + json.dumps(directory.to_json(quota))[1:]
+
+    def write_snapshot(self, snapshot):
+        # Runs alongside writers: it reads the captured state through snapshot_json
+        snapshot["structure"] = self.snapshot_json(snapshot["root"], snapshot)
+        tmp_file = self.data_file + ".tmp"
+        if snapshot["format"] == "binary":
+            extents = self.save_image(tmp_file, snapshot)
+        else:
+            extents = None
+            self.save_json(tmp_file, snapshot)
+        for blocks, view, ascii in snapshot["files"].values():
+            if view is not None:
+                view.release()
+        return extents
+
+    def install_snapshot(self, snapshot, extents):
+        # Atomically replaces data_file with the freshly written (and fsynced) snapshot, exclusive lock held
+        tmp_file = self.data_file + ".tmp"
+        self.thaw()
+        if extents is not None:
+            # Files mapped from the old image that the snapshot lacks (copied since) move into blocks
+            for data_id in list(self.memory_map.mapped):
+                if data_id not in extents:
+                    self.memory_map.materialize(data_id)
+            mapped = self.memory_map.unmap()
+            self.unmap_image()
+            os.replace(tmp_file, self.data_file)
+            # Files that were still served from the old image are re-pointed at the new one
+            self.map_image()
+            for data_id in mapped:
+                offset, nbytes, marker = extents[data_id][:3]
+                layout = extents[data_id][3] if len(extents[data_id]) > 3 else None
+                self.memory_map.map_extent(data_id, self.image_view[offset:offset + nbytes],
+                                           marker == self.memory_map.length(data_id), layout,
+                                           snapshot["chars"].get(data_id))
+        else:
+            for data_id in list(self.memory_map.mapped):
+                self.memory_map.materialize(data_id)
+            self.unmap_image()
+            os.replace(tmp_file, self.data_file)
+        # The rename has to be durable before finish_checkpoint drops the journal records it covers
+        fsync_path(os.path.dirname(os.path.abspath(self.data_file)))
+        self.snapshot_size = os.path.getsize(self.data_file)
+
+    def save_json(self, tmp_file, snapshot):
+        with open(tmp_file, 'w') as f:
+            f.write('{"structure": {"/": ' + snapshot["structure"] + "}")
+            f.write(', "journal_seq": %d, "block_size": %d, "next_inode": %d' % (
+                snapshot["journal_seq"], snapshot["block_size"], snapshot["next_inode"]))
+            # Written a block at a time (JSON escaping is per character) so no file is joined into one
+            # string. Bytes that are not valid UTF-8 round-trip as escaped surrogates.
+            f.write(', "memory_map": {')
+            for i, (data_id, (blocks, view, ascii)) in enumerate(snapshot["files"].items()):
+                f.write((", " if i else "") + json.dumps(str(data_id)) + ': "')
+                decoder = codecs.getincrementaldecoder("utf-8")("surrogateescape")
+                if view is None:
+                    chunks = map(unpack, blocks)
+                elif data_id in snapshot["layouts"]:
+                    chunks = map(unpack, packed_blocks(view, snapshot["layouts"][data_id]))
+                else:
+                    chunks = [view]
+                for chunk in chunks:
+                    f.write(json.dumps(decoder.decode(chunk))[1:-1])
+                f.write(json.dumps(decoder.decode(b"", True))[1:-1] + '"')
+            f.write('}}')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save_image(self, tmp_file, snapshot):
+        extents = {}
+        with open(tmp_file, 'wb') as f:
+            f.write(IMAGE_MAGIC)
+            for data_id, (blocks, view, ascii) in snapshot["files"].items():
+                offset = f.tell()
+                layout = None
+                if view is not None:
+                    f.write(view)  # Mapped content is copied through untouched
+                    layout = snapshot["layouts"].get(data_id)
+                    length = len(view) if layout is None else sum(
+                        size if codec is None else snapshot["block_size"] for codec, size in layout)
+                elif all(type(block) is bytes for block in blocks):
+                    for block in blocks:
+                        f.write(block)
+                    length = f.tell() - offset
+                else:
+                    # Compressed blocks are written as stored, with a [codec, stored size] entry per block
+                    layout = []
+                    for block in blocks:
+                        if type(block) is bytes:
+                            f.write(block)
+                            layout.append([None, len(block)])
+                        else:
+                            f.write(block.data)
+                            layout.append([block.codec, len(block.data)])
+                    length = sum(size if codec is None else snapshot["block_size"] for codec, size in layout)
+                nbytes = f.tell() - offset
+                # The third field equals the content length only for pure ASCII content
+                extents[data_id] = [offset, nbytes, length if ascii else -1]
+                if layout is not None:
+                    extents[data_id].append(layout)
+            meta_offset = f.tell()
+            f.write(b'{"structure": {"/": ' + snapshot["structure"].encode("utf-8") + b"}, ")
+            f.write(json.dumps({
+                "journal_seq": snapshot["journal_seq"],
+                "next_inode": snapshot["next_inode"],
+                "block_size": snapshot["block_size"],
+                "extents": extents,
+                "chars": snapshot["chars"]  # Characters per block of non-ASCII files
+            })[1:].encode("utf-8"))
+            f.write(struct.pack("<Q", meta_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        return extents
+
+    def map_image(self):
+        with open(self.data_file, 'rb') as f:
+            self.image_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.image_view = memoryview(self.image_map)
+
+    def unmap_image(self):
+        if self.image_map is not None:
+            self.image_view.release()
+            self.image_map.close()
+            self.image_map = self.image_view = None
+
+    def load_image(self):
+        # Only the metadata is decoded; file content stays in the map until it is read
+        self.map_image()
+        meta_offset = struct.unpack("<Q", self.image_map[-8:])[0]
+        meta = json.loads(self.image_map[meta_offset:-8])
+        self.next_inode = meta.get("next_inode", 1)
+        self.fs_structure = {"/": self.node_from_json(meta["structure"]["/"])}
+        self.memory_map = self.new_block_store(meta["block_size"])
+        chars = meta.get("chars", {})  # Older images have none: those files are counted on first use
+        for data_id, extent in meta["extents"].items():
+            offset, nbytes, marker = extent[:3]
+            view = self.image_view[offset:offset + nbytes]
+            if len(extent) > 3:
+                # Compressed files stay mapped as well, and are split into blocks on first use
+                layout = extent[3]
+                length = sum(size if codec is None else meta["block_size"] for codec, size in layout)
+                self.memory_map.map_extent(self.resolve_id(data_id), view, marker == length, layout,
+                                           chars.get(data_id))
+            else:
+                self.memory_map.map_extent(self.resolve_id(data_id), view, marker == nbytes, None,
+                                           chars.get(data_id))
+        return meta.get("journal_seq", 0)
+
+    def is_binary_image(self):
+        with open(self.data_file, 'rb') as f:
+            return f.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
 
     def load_data(self):
-        if os.path.exists(self.data_file):
+        snapshot_seq = 0
+        if os.path.exists(self.data_file) and self.is_binary_image():
+            snapshot_seq = self.load_image()
+            self.snapshot_size = os.path.getsize(self.data_file)
+        elif os.path.exists(self.data_file):
             with open(self.data_file, 'r') as f:
                 data = json.load(f)
-                self.fs_structure = data["structure"]
-                self.memory_map = data.get("memory_map", {})
+                self.next_inode = data.get("next_inode", 1)
+                self.fs_structure = {"/": self.node_from_json(data["structure"]["/"])}
+                self.memory_map = self.new_block_store(data.get("block_size", self.memory_map.block_size))
+                for data_id, content in data.get("memory_map", {}).items():
+                    data_id = self.resolve_id(data_id)
+                    self.memory_map.allocate(data_id)
+                    self.memory_map.write(data_id, 0, content.encode("utf-8", "surrogateescape"))
+                snapshot_seq = data.get("journal_seq", 0)
+            self.snapshot_size = os.path.getsize(self.data_file)
+        with self.cache_lock:
+            self.dir_cache.clear()
+        self.rebuild_data_paths()
+        self.journal_seq = snapshot_seq
+        # Records already folded into the snapshot are skipped
+        for header, payload in self.journal.replay():
+            if header["seq"] <= snapshot_seq:
+                continue
+            self.apply_record(header, payload)
+            self.journal_seq = header["seq"]
+
+    def new_inode(self):
+        inode = self.next_inode
+        self.next_inode += 1
+        return inode
+
+    def resolve_id(self, data_id):
+        # Maps a persisted data_id (inode number, or uuid from an older image) to its inode.
+        # Older ids are numbered in load order, so the mapping is the same on every load.
+        if isinstance(data_id, int):
+            return data_id
+        if data_id.isdigit():
+            return int(data_id)
+        if data_id not in self.legacy_ids:
+            self.legacy_ids[data_id] = self.new_inode()
+        return self.legacy_ids[data_id]
+
+    def node_from_json(self, info):
+        created = parse_time(info["created"])
+        if info["type"] == "file":
+            return FileNode(self.resolve_id(info["data_id"]), created, info.get("size", 0))
+        node = DirNode(info.get("inode") or self.new_inode(), created)
+        node.quota = info.get("quota")
+        for name, child in info["contents"].items():
+            child = node.contents[sys.intern(name)] = self.node_from_json(child)
+            if child.type == "directory":
+                child.parent = node
+            nbytes, files, dirs = child.totals()
+            node.total_bytes += nbytes
+            node.total_files += files
+            node.total_dirs += dirs
+        return node
+
+    def rebuild_data_paths(self):
+        self.data_paths = {}
+        self.names = NameIndex()
+        self.index_subtree(self.fs_structure["/"], "/")
+
+    def index_subtree(self, directory, path):
+        # Records the current path of every entry under directory (files in data_paths too)
+        for name, info in directory.contents.items():
+            full_path = os.path.join(path, name).replace("\\", "/")
+            self.names.add(name, full_path)
+            if info.type == "file":
+                self.data_paths[info.inode] = full_path
+            else:
+                self.index_subtree(info, full_path)
+
+    def unindex_names(self, directory, path):
+        # Drops every entry under a deleted or moved directory from the name index
+        stack = [(directory, path)]
+        while stack:
+            directory, path = stack.pop()
+            for name, info in directory.contents.items():
+                full_path = os.path.join(path, name).replace("\\", "/")
+                self.names.discard(name, full_path)
+                if info.type == "directory":
+                    stack.append((info, full_path))
+
+    def release_subtree(self, directory):
+        # Frees the content of every file under a deleted directory
+        stack = [directory]
+        while stack:
+            for info in stack.pop().contents.values():
+                if info.type == "file":
+                    self.release_file(info.inode)
+                else:
+                    stack.append(info)
+
+    def release_file(self, data_id):
+        self.memory_map.release(data_id)
+        self.data_paths.pop(data_id, None)
+        self.file_locks.pop(data_id, None)
+        if self.text_index is not None:
+            self.text_index.touch(data_id)
+
+    def checkpoint(self, background=False):
+        # Captures a snapshot under the lock and writes it out, on a worker thread if
+        # background is set, so writers only wait for the capture
+        thread = self.snapshot_thread
+        if thread is not None:
+            if background:
+                return "Checkpoint already in progress"
+            thread.join()
+        with self.lock.exclusive():
+            if self.snapshot_thread is not None:
+                return "Checkpoint already in progress"
+            if self.txn_records is not None:
+                # The snapshot would hold uncommitted changes, which undo could then not drop
+                self.checkpoint_due = True
+                return "Checkpoint deferred until the transaction ends"
+            snapshot = self.capture_snapshot()
+            with self.journal_lock:
+                self.journal.rotate()
+            self.checkpoint_due = False
+            if background:
+                self.snapshot_thread = threading.Thread(target=self.finish_checkpoint, args=(snapshot,))
+                self.snapshot_thread.start()
+                return "Checkpoint started"
+        self.finish_checkpoint(snapshot)
+        return "Checkpoint complete"
+
+    def finish_checkpoint(self, snapshot):
+        try:
+            extents = self.write_snapshot(snapshot)
+            with self.lock.exclusive():
+                self.install_snapshot(snapshot, extents)
+                with self.journal_lock:
+                    self.journal.drop_old()
+        finally:
+            with self.lock.exclusive():
+                self.thaw()
+            self.snapshot_thread = None
+
+    def flush(self):
+        # Makes every logged mutation durable
+        with self.journal_lock:
+            self.journal.sync()
+            self.unflushed = 0
+            self.last_flush = time.monotonic()
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+        return "Flush complete"
+
+    def schedule_flush(self):
+        # Applies the durability policy after a record has been logged
+        if self.batch_depth or self.durability == "immediate":
+            return
+        if self.durability == "batch":
+            if self.batch_size is not None and self.unflushed >= self.batch_size:
+                self.flush()
+            return
+        remaining = self.flush_interval / 1000 - (time.monotonic() - self.last_flush)
+        if remaining <= 0:
+            self.flush()
+        else:
+            with self.journal_lock:
+                if self.flush_timer is None:
+                    # Picks up records that would otherwise wait for the next operation
+                    self.flush_timer = threading.Timer(remaining, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+
+    @contextmanager
+    def batch(self):
+        # Defers this thread's flushes and checkpoints until its outermost block exits
+        depth = self.batch_depth
+        self.batch_state.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self.batch_state.depth = depth
+            if not depth:
+                self.flush()
+                self.checkpoint_if_due()
+
+    @contextmanager
+    def transaction(self):
+        # All-or-nothing group of mutations. They apply as they run (other threads are held off
+        # until the block exits) and are logged as one record on exit, so a crash never leaves
+        # half of them behind. If the block raises they are undone; Rollback is not re-raised.
+        if self.txn_records is not None and self.lock.owned():
+            # Nested blocks join the outer transaction, but if one raises only its own part is undone
+            start = len(self.txn_records)
+            current_dir = self.current_dir
+            try:
+                yield self
+            except BaseException as exc:
+                records = self.txn_records
+                self.txn_records = records[:start]
+                self.undo(records, current_dir, records[:start])
+                if not isinstance(exc, Rollback):
+                    raise
+            return
+        with self.batch():
+            while True:
+                with self.lock.exclusive():
+                    # An undo reloads the image, which must not be replaced meanwhile
+                    thread = self.snapshot_thread
+                    if thread is None:
+                        current_dir = self.current_dir
+                        self.txn_records = []
+                        try:
+                            yield self
+                        except BaseException as exc:
+                            records, self.txn_records = self.txn_records, None
+                            self.undo(records, current_dir)
+                            if not isinstance(exc, Rollback):
+                                raise
+                            return
+                        records, self.txn_records = self.txn_records, None
+                        if records:
+                            for header, payload in records:
+                                if payload:
+                                    header["len"] = len(payload)
+                            self.log({"op": "txn", "records": [header for header, payload in records]},
+                                     b"".join(payload for header, payload in records))
+                        return
+                thread.join()
+
+    def undo(self, records, current_dir, keep=()):
+        # Drops an uncommitted transaction by rebuilding the state from the image and journal,
+        # which it never reached; this costs as much as a restart but only happens on failure.
+        # keep: its leading records that stay (a nested block failed), applied again afterwards.
+        touched = set(self.memory_map)
+        with self.journal_lock:
+            self.journal.close()  # Earlier buffered records reach the file before it is replayed
+        self.memory_map.unmap()
+        self.unmap_image()
+        root = self.fs_structure["/"]
+        issued = self.next_inode  # Inodes handed out inside the transaction are never reused
+        self.next_inode = 1
+        self.legacy_ids = {}
+        self.fs_structure = {"/": DirNode(self.new_inode(), root.created)}
+        self.memory_map = self.new_block_store(self.memory_map.block_size)
+        self.load_data()
+        self.next_inode = max(self.next_inode, issued)
+        for header, payload in keep:
+            self.apply_record(header, payload)
+        # Handles on files the transaction created are closed, as their content is gone
+        for fd, file_obj in list(self.open_files.items()):
+            if file_obj.data_id not in self.memory_map:
+                del self.open_files[fd]
+                file_obj.fd = None
+                remaining = self.open_counts.pop(file_obj.data_id) - 1
+                if remaining:
+                    self.open_counts[file_obj.data_id] = remaining
+        if self.text_index is not None:
+            touched ^= set(self.memory_map)
+            touched.update(header["id"] for header, payload in records if "id" in header)
+            for data_id in touched:
+                self.text_index.touch(data_id)
+        self.current_dir = current_dir if self.get_directory(current_dir) else "/"
+
+    def apply(self, ops):
+        # Runs (op, *args) tuples from TRANSACTION_OPS as one transaction, persisted once, and
+        # returns a result string per op. If one fails nothing takes effect: it reports its error,
+        # the ops before it "Rolled back" and the ones after it "Skipped".
+        for i, op in enumerate(ops):
+            spec = TRANSACTION_OPS.get(op[0]) if op else None
+            if spec is None or not spec[0] <= len(op) - 1 <= spec[1]:
+                results = ["Skipped"] * len(ops)
+                results[i] = f"Invalid operation: {op[0] if op else op}"
+                return results
+        results = []
+        failed = False
+        with self.transaction():
+            for op in ops:
+                min_args, max_args, run, success = TRANSACTION_OPS[op[0]]
+                results.append(run(self, *op[1:]))
+                if results[-1] != success.format(*op[1:]):
+                    failed = True
+                    raise Rollback
+        if failed:
+            return ["Rolled back"] * (len(results) - 1) + results[-1:] + ["Skipped"] * (len(ops) - len(results))
+        return results
+
+    def checkpoint_if_due(self):
+        # Called by content operations once they have released their shared lock
+        if self.checkpoint_due and not self.batch_depth and self.snapshot_thread is None:
+            self.checkpoint(background=True)
+
+    def file_lock(self, data_id):
+        with self.file_locks_guard:
+            lock = self.file_locks.get(data_id)
+            if lock is None:
+                lock = self.file_locks[data_id] = threading.RLock()
+            return lock
+
+    def perform(self, header, payload=b""):
+        # Apply a mutation in memory and append it to the journal
+        self.apply_record(header, payload)
+        if self.txn_records is not None:
+            self.txn_records.append((header, payload))
+            return
+        self.log(header, payload)
+
+    def log(self, header, payload=b""):
+        with self.journal_lock:
+            self.journal_seq += 1
+            header["seq"] = self.journal_seq
+            self.journal.append(header, payload, self.durability == "immediate" and not self.batch_depth)
+            self.unflushed += 1
+            # Compact once the journal outgrows the snapshot so each op stays O(change) amortized
+            if self.journal.size > max(self.journal_limit, self.snapshot_size):
+                self.checkpoint_due = True
+        self.schedule_flush()
+        if self.lock.owned():
+            self.checkpoint_if_due()
+
+    def apply_record(self, header, payload):
+        getattr(self, "apply_" + header["op"])(header, payload)
+
+    def apply_txn(self, rec, payload):
+        # A committed transaction: its records in order, with their payloads concatenated
+        offset = 0
+        for header in rec["records"]:
+            length = header.get("len", 0)
+            self.apply_record(header, payload[offset:offset + length])
+            offset += length
+
+    def apply_create(self, rec, payload):
+        parent = self.get_directory(os.path.dirname(rec["path"]))
+        self.preserve(parent)
+        inode = self.resolve_id(rec["data_id"])
+        self.next_inode = max(self.next_inode, inode + 1)
+        parent.contents[sys.intern(os.path.basename(rec["path"]))] = FileNode(inode, parse_time(rec["created"]))
+        self.memory_map.allocate(inode)
+        self.data_paths[inode] = rec["path"]
+        self.names.add(sys.intern(os.path.basename(rec["path"])), rec["path"])
+        self.add_totals(parent, 0, 1, 0)
+
+    def apply_mkdir(self, rec, payload):
+        parent = self.get_directory(os.path.dirname(rec["path"]))
+        self.preserve(parent)
+        inode = rec["inode"] if "inode" in rec else self.new_inode()
+        self.next_inode = max(self.next_inode, inode + 1)
+        node = parent.contents[sys.intern(os.path.basename(rec["path"]))] = DirNode(inode, parse_time(rec["created"]))
+        node.parent = parent
+        self.names.add(sys.intern(os.path.basename(rec["path"])), rec["path"])
+        self.add_totals(parent, 0, 0, 1)
+
+    def apply_delete(self, rec, payload):
+        parent = self.get_directory(os.path.dirname(rec["path"]))
+        fname = os.path.basename(rec["path"])
+        node = parent.contents[fname]
+        self.preserve(parent)
+        if node.type == "file":
+            self.release_file(node.inode)
+        else:
+            self.invalidate_dirs(rec["path"])
+            self.release_subtree(node)
+            self.unindex_names(node, rec["path"])
+        self.names.discard(fname, rec["path"])
+        self.add_totals(parent, *(-n for n in node.totals()))
+        del parent.contents[fname]
+
+    def apply_move(self, rec, payload):
+        src_parent = self.get_directory(os.path.dirname(rec["src"]))
+        tgt_parent = self.get_directory(os.path.dirname(rec["dst"]))
+        source_name = os.path.basename(rec["src"])
+        node = src_parent.contents[source_name]
+        self.preserve(src_parent)
+        self.preserve(tgt_parent)
+        self.names.discard(source_name, rec["src"])
+        self.names.add(sys.intern(os.path.basename(rec["dst"])), rec["dst"])
+        if node.type == "directory":
+            self.invalidate_dirs(rec["src"])
+            self.unindex_names(node, rec["src"])
+            self.index_subtree(node, rec["dst"])
+            node.parent = tgt_parent
+        else:
+            self.data_paths[node.inode] = rec["dst"]
+        tgt_parent.contents[sys.intern(os.path.basename(rec["dst"]))] = node
+        del src_parent.contents[source_name]
+        totals = node.totals()
+        self.add_totals(src_parent, *(-n for n in totals))
+        self.add_totals(tgt_parent, *totals)
+
+    def apply_quota(self, rec, payload):
+        directory = self.get_directory(rec["path"])
+        self.preserve(directory)
+        if rec["bytes"] is None and rec["inodes"] is None:
+            directory.quota = None
+        else:
+            directory.quota = [rec["bytes"], rec["inodes"]]
+
+    def apply_copy(self, rec, payload):
+        # New nodes are numbered from rec["inode"] in traversal order, so replay assigns the same inodes
+        src_parent = self.get_directory(os.path.dirname(rec["src"]))
+        tgt_parent = self.get_directory(os.path.dirname(rec["dst"]))
+        self.preserve(tgt_parent)
+        inodes = iter(range(rec["inode"], sys.maxsize))
+        created = parse_time(rec["created"])
+        source = src_parent.contents[os.path.basename(rec["src"])]
+        copy = FileNode(next(inodes), created, source.size) if source.type == "file" else DirNode(next(inodes), created)
+        stack = [(source, copy, rec["dst"])]
+        while stack:
+            node, new, path = stack.pop()
+            if node.type == "file":
+                self.memory_map.clone(node.inode, new.inode)
+                self.data_paths[new.inode] = path
+                if self.text_index is not None:
+                    self.text_index.touch(new.inode)
+                continue
+            new.total_bytes, new.total_files, new.total_dirs = node.total_bytes, node.total_files, node.total_dirs
+            for name, child in node.contents.items():
+                if child.type == "file":
+                    new.contents[name] = FileNode(next(inodes), created, child.size)
+                else:
+                    new.contents[name] = DirNode(next(inodes), created)
+                    new.contents[name].parent = new
+                child_path = os.path.join(path, name).replace("\\", "/")
+                self.names.add(name, child_path)
+                stack.append((child, new.contents[name], child_path))
+        self.next_inode = max(self.next_inode, next(inodes))
+        self.names.add(sys.intern(os.path.basename(rec["dst"])), rec["dst"])
+        tgt_parent.contents[sys.intern(os.path.basename(rec["dst"]))] = copy
+        if copy.type == "directory":
+            copy.parent = tgt_parent
+        self.add_totals(tgt_parent, *copy.totals())
+
+    def apply_bwrite(self, rec, payload):
+        store = self.memory_map
+        data_id = self.resolve_id(rec["id"])
+        if rec.get("trunc"):
+            store.truncate(data_id, rec["at"])
+        at = min(rec["at"], store.length(data_id))
+        store.write(data_id, at, payload)
+        self.content_changed(data_id, at, None if rec.get("trunc") else at + len(payload))
+
+    def apply_bsplice(self, rec, payload):
+        data_id = self.resolve_id(rec["id"])
+        self.memory_map.splice(data_id, rec["at"], rec["cut"], payload)
+        self.content_changed(data_id, rec["at"], rec["at"] + rec["cut"] if rec["cut"] == len(payload) else None)
+
+    def apply_bshift(self, rec, payload):
+        # Cutting a range out and reinserting it only rearranges the span between
+        # the source and the destination, so only the blocks under that span are rewritten
+        store = self.memory_map
+        data_id = self.resolve_id(rec["id"])
+        start, size = rec["start"], rec["size"]
+        target = min(rec["target"], store.length(data_id) - size)
+        if target <= start:
+            span = store.read(data_id, start, size) + store.read(data_id, target, start - target)
+            store.write(data_id, target, span)
+        else:
+            span = store.read(data_id, start + size, target - start) + store.read(data_id, start, size)
+            store.write(data_id, start, span)
+        self.content_changed(data_id, min(start, target), max(start, target) + size)
+
+    def apply_btruncate(self, rec, payload):
+        data_id = self.resolve_id(rec["id"])
+        self.memory_map.truncate(data_id, rec["size"])
+        self.content_changed(data_id, rec["size"])
+
+    def content_changed(self, data_id, start=0, end=None):
+        # Called after every change to a file's content (bytes start..end, None: to the end): queues
+        # it for the text index and refreshes its size. Resolved through the reverse index, so it
+        # follows files moved while open.
+        if self.text_index is not None:
+            self.text_index.touch(data_id, start, end)
+        path = self.data_paths.get(data_id)
+        if path is None:
+            return
+        parent = self.get_directory(os.path.dirname(path))
+        fname = os.path.basename(path)
+        if parent and fname in parent.contents:
+            node = parent.contents[fname]
+            size = self.memory_map.length(data_id)
+            delta = size - node.size
+            node.size = size
+            if delta:
+                self.add_totals(parent, delta, 0, 0)
+
+    def add_totals(self, directory, nbytes, files, dirs):
+        # Applies a change to the aggregates of directory and each of its ancestors, O(depth)
+        with self.totals_lock:
+            while directory is not None:
+                directory.total_bytes += nbytes
+                directory.total_files += files
+                directory.total_dirs += dirs
+                directory = directory.parent
 
     def get_full_path(self, name):
         if name.startswith("/"):
@@ -33,260 +1779,1251 @@ class FileSystem:
         return os.path.join(self.current_dir, name).replace("\\", "/")
 
     def create(self, fName):
-        full_path = self.get_full_path(fName)
-        parent_path = os.path.dirname(full_path)
-        fname = os.path.basename(full_path)
-
-        parent = self.get_directory(parent_path)
-        if not parent:
-            return "Parent directory does not exist"
-        if fname in parent["contents"]:
-            return "File/directory already exists"
-
-        parent["contents"][fname] = {
-            "type": "file",
-            "size": 0,
-            "created": str(datetime.now()),
-            "data_id": str(uuid.uuid4())
-        }
-        self.memory_map[parent["contents"][fname]["data_id"]] = ""
-        self.save_data()
-        return f"File {fName} created"
+        with self.lock.exclusive():
+            full_path = self.get_full_path(fName)
+            parent_path = os.path.dirname(full_path)
+            fname = os.path.basename(full_path)
+
+            parent = self.get_directory(parent_path)
+            if not parent:
+                return "Parent directory does not exist"
+            if fname in parent.contents:
+                return "File/directory already exists"
+            error = self.check_space(parent_path, 0, 1)
+            if error:
+                return error
+
+            self.perform({"op": "create", "path": full_path, "data_id": self.new_inode(), "created": time.time()})
+            return f"File {fName} created"
 
     def delete(self, fName):
-        full_path = self.get_full_path(fName)
-        parent_path = os.path.dirname(full_path)
-        fname = os.path.basename(full_path)
+        with self.lock.exclusive():
+            full_path = self.get_full_path(fName)
+            parent_path = os.path.dirname(full_path)
+            fname = os.path.basename(full_path)
 
-        parent = self.get_directory(parent_path)
-        if not parent or fname not in parent["contents"]:
-            return "File/directory does not exist"
+            parent = self.get_directory(parent_path)
+            if not parent or fname not in parent.contents:
+                return "File/directory does not exist"
 
-        if parent["contents"][fname]["type"] == "file":
-            data_id = parent["contents"][fname]["data_id"]
-            del self.memory_map[data_id]
-        del parent["contents"][fname]
-        self.save_data()
-        return f"{fName} deleted"
+            self.perform({"op": "delete", "path": full_path})
+            return f"{fName} deleted"
 
     def mkdir(self, dirName):
-        full_path = self.get_full_path(dirName)
-        parent_path = os.path.dirname(full_path)
-        dirname = os.path.basename(full_path)
+        with self.lock.exclusive():
+            full_path = self.get_full_path(dirName)
+            parent_path = os.path.dirname(full_path)
+            dirname = os.path.basename(full_path)
 
-        parent = self.get_directory(parent_path)
-        if not parent:
-            return "Parent directory does not exist"
-        if dirname in parent["contents"]:
-            return "Directory already exists"
+            parent = self.get_directory(parent_path)
+            if not parent:
+                return "Parent directory does not exist"
+            if dirname in parent.contents:
+                return "Directory already exists"
+            error = self.check_space(parent_path, 0, 1)
+            if error:
+                return error
 
-        parent["contents"][dirname] = {
-            "type": "directory",
-            "contents": {},
-            "created": str(datetime.now())
-        }
-        self.save_data()
-        return f"Directory {dirName} created"
+            self.perform({"op": "mkdir", "path": full_path, "inode": self.new_inode(), "created": time.time()})
+            return f"Directory {dirName} created"
 
     def chdir(self, dirName):
-        full_path = self.get_full_path(dirName)
-        directory = self.get_directory(full_path)
-        if not directory or directory["type"] != "directory":
-            return "Directory does not exist"
-        self.current_dir = full_path
-        return f"Changed to {dirName}"
+        with self.lock.exclusive():
+            full_path = self.get_full_path(dirName)
+            directory = self.get_directory(full_path)
+            if not directory or directory.type != "directory":
+                return "Directory does not exist"
+            self.current_dir = full_path
+            return f"Changed to {dirName}"
 
     def move(self, source_fName, target_fName):
-        source_path = self.get_full_path(source_fName)
-        target_path = self.get_full_path(target_fName)
-        source_parent = os.path.dirname(source_path)
-        target_parent = os.path.dirname(target_path)
-        source_name = os.path.basename(source_path)
-        target_name = os.path.basename(target_path)
-
-        src_parent = self.get_directory(source_parent)
-        tgt_parent = self.get_directory(target_parent)
-
-        if not src_parent or source_name not in src_parent["contents"]:
-            return "Source does not exist"
-        if not tgt_parent:
-            return "Target directory does not exist"
-        if target_name in tgt_parent["contents"]:
-            return "Target already exists"
-
-        tgt_parent["contents"][target_name] = src_parent["contents"][source_name]
-        del src_parent["contents"][source_name]
-        self.save_data()
-        return f"Moved {source_fName} to {target_fName}"
+        with self.lock.exclusive():
+            source_path = self.get_full_path(source_fName)
+            target_path = self.get_full_path(target_fName)
+            source_parent = os.path.dirname(source_path)
+            target_parent = os.path.dirname(target_path)
+            source_name = os.path.basename(source_path)
+            target_name = os.path.basename(target_path)
+
+            src_parent = self.get_directory(source_parent)
+            tgt_parent = self.get_directory(target_parent)
+
+            if not src_parent or source_name not in src_parent.contents:
+                return "Source does not exist"
+            if not tgt_parent:
+                return "Target directory does not exist"
+            if target_name in tgt_parent.contents:
+                return "Target already exists"
+            if (target_path + "/").startswith(source_path.rstrip("/") + "/"):
+                return "Cannot move a directory into itself"
+            nbytes, files, dirs = src_parent.contents[source_name].totals()
+            error = self.check_space(target_parent, nbytes, files + dirs, moved_from=source_path)
+            if error:
+                return error
+
+            self.perform({"op": "move", "src": source_path, "dst": target_path})
+            return f"Moved {source_fName} to {target_fName}"
+
+    def copy_tree(self, source_fName, target_fName):
+        # Copies a file or a whole directory tree as a single journal record; the copies share
+        # content blocks with the originals until either side is written
+        with self.lock.exclusive():
+            source_path = self.get_full_path(source_fName)
+            target_path = self.get_full_path(target_fName)
+            src_parent = self.get_directory(os.path.dirname(source_path))
+            tgt_parent = self.get_directory(os.path.dirname(target_path))
+            source_name = os.path.basename(source_path)
+
+            if not src_parent or source_name not in src_parent.contents:
+                return "Source does not exist"
+            if not tgt_parent:
+                return "Target directory does not exist"
+            if os.path.basename(target_path) in tgt_parent.contents:
+                return "Target already exists"
+            if (target_path + "/").startswith(source_path.rstrip("/") + "/"):
+                return "Cannot copy a directory into itself"
+            nbytes, files, dirs = src_parent.contents[source_name].totals()
+            error = self.check_space(os.path.dirname(target_path), nbytes, files + dirs)
+            if error:
+                return error
+
+            self.perform({"op": "copy", "src": source_path, "dst": target_path,
+                          "inode": self.next_inode, "created": time.time()})
+            return f"Copied {source_fName} to {target_fName}"
+
+    def set_quota(self, dirName, max_bytes=None, max_inodes=None):
+        # Limits the content bytes and the number of files plus directories under dirName;
+        # passing neither removes the quota
+        with self.lock.exclusive():
+            full_path = self.get_full_path(dirName)
+            if not self.get_directory(full_path):
+                return "Directory does not exist"
+            for limit in (max_bytes, max_inodes):
+                if limit is not None and (type(limit) is not int or limit < 0):
+                    return "Invalid quota limit"
+            self.perform({"op": "quota", "path": full_path, "bytes": max_bytes, "inodes": max_inodes})
+            return f"Quota on {dirName} updated"
+
+    def check_space(self, dir_path, nbytes, inodes, moved_from=None):
+        # Error string if adding nbytes and inodes under dir_path would break the capacity limit
+        # or a quota on it or one of its ancestors, else None. Quotas on directories that also
+        # contain moved_from are skipped, since a move within them doesn't change their usage.
+        if self.capacity is not None and moved_from is None and nbytes > 0:
+            if self.fs_structure["/"].total_bytes + nbytes > self.capacity:
+                return "Capacity limit reached"
+        directory = self.get_directory(dir_path)
+        path = dir_path
+        while directory is not None:
+            if directory.quota is not None and not (
+                    moved_from is not None and moved_from.startswith(path.rstrip("/") + "/")):
+                max_bytes, max_inodes = directory.quota
+                if max_bytes is not None and nbytes > 0 and directory.total_bytes + nbytes > max_bytes:
+                    return f"Byte quota exceeded for {path}"
+                if (max_inodes is not None and inodes > 0
+                        and directory.total_files + directory.total_dirs + inodes > max_inodes):
+                    return f"Inode quota exceeded for {path}"
+            directory = directory.parent
+            path = os.path.dirname(path)
+        return None
+
+    def rmtree(self, dirName):
+        # Removes a directory and everything beneath it, freeing all of their content, as one record
+        with self.lock.exclusive():
+            full_path = self.get_full_path(dirName)
+            if full_path == "/":
+                return "Cannot remove the root directory"
+            parent = self.get_directory(os.path.dirname(full_path))
+            node = parent.contents.get(os.path.basename(full_path)) if parent else None
+            if node is None or node.type != "directory":
+                return "Directory does not exist"
+
+            self.perform({"op": "delete", "path": full_path})
+            return f"Directory {dirName} removed"
+
+    def walk(self, dir_path=None):
+        # Top-down (dirpath, dirnames, filenames) generator, like os.walk; removing names from
+        # dirnames skips those subtrees. Each directory is listed under the shared lock.
+        full_path = self.get_full_path(dir_path or self.current_dir)
+        with self.lock.shared():
+            directory = self.get_directory(full_path)
+        stack = [(full_path, directory)] if directory else []
+        while stack:
+            path, directory = stack.pop()
+            with self.lock.shared():
+                entries = list(directory.contents.items())
+            dirnames = [name for name, info in entries if info.type == "directory"]
+            filenames = [name for name, info in entries if info.type == "file"]
+            yield path, dirnames, filenames
+            subdirs = dict(entries)
+            for name in reversed(dirnames):
+                if subdirs.get(name) is not None and subdirs[name].type == "directory":
+                    stack.append((os.path.join(path, name).replace("\\", "/"), subdirs[name]))
+
+    def du(self, path=None):
+        # Total content bytes of a file or of everything under a directory (None if it doesn't exist)
+        with self.lock.shared():
+            full_path = self.get_full_path(path or self.current_dir)
+            node = self.get_directory(full_path)
+            if node is None:
+                parent = self.get_directory(os.path.dirname(full_path))
+                node = parent.contents.get(os.path.basename(full_path)) if parent else None
+                if node is None:
+                    return None
+            return node.size if node.type == "file" else node.total_bytes
+
+    def find(self, pattern, dir_path=None):
+        # Sorted full paths of the files and directories whose name matches pattern (fnmatch
+        # syntax), optionally only under dir_path. Exact names and patterns with a literal
+        # prefix are answered from the name index without scanning.
+        with self.lock.shared():
+            found = [path for name in self.matching_names(pattern) for path in self.names.exact(name)]
+        if dir_path is not None:
+            prefix = self.get_full_path(dir_path).rstrip("/") + "/"
+            found = [path for path in found if path.startswith(prefix)]
+        return sorted(found)
+
+    def glob(self, pattern):
+        # Sorted full paths matching a path glob such as "**/*.log" or "/var/*/today.txt",
+        # relative to the current directory unless absolute
+        full_pattern = self.get_full_path(pattern)
+        regex = glob_regex(full_pattern)
+        last = full_pattern.rsplit("/", 1)[-1]
+        with self.lock.shared():
+            if "**" in last:
+                names = list(self.names.paths)  # The last component can span directories
+            else:
+                names = self.matching_names(last)
+            return sorted(path for name in names for path in self.names.exact(name) if regex.match(path))
+
+    def matching_names(self, pattern):
+        # Distinct indexed names matching an fnmatch pattern
+        literal = re.match(r"[^*?\[]*", pattern).group()
+        if literal == pattern:
+            return [pattern] if pattern in self.names.paths else []
+        if literal:
+            candidates = self.names.prefixed(literal)
+        else:
+            candidates = self.names.paths
+        return [name for name in candidates if fnmatch.fnmatchcase(name, pattern)]
+
+    def search(self, text):
+        # Case-insensitive full-text search for text as whole words (a phrase if it spans several).
+        # Returns (path, character offsets) pairs sorted by path. The inverted index is built in
+        # the background on first use; files it hasn't caught up with are scanned directly.
+        if self.text_index is None:
+            with self.lock.exclusive():
+                if self.text_index is None:
+                    self.text_index = TextIndex(self)
+                    for data_id in self.memory_map:
+                        self.text_index.touch(data_id)
+        words = WORD_RE.findall(text.lower())
+        if not words:
+            raise ValueError("Search text must contain at least one word")
+        pattern = re.escape(text)
+        if WORD_RE.match(text[:1]):
+            pattern = r"(?<!\w)" + pattern
+        if WORD_RE.match(text[-1:]):
+            pattern += r"(?!\w)"
+        regex = re.compile(pattern, re.IGNORECASE)
+        results = []
+        for data_id in self.text_index.candidates(words):
+            content = self.read_content(data_id)
+            path = self.data_paths.get(data_id)
+            if content is None or path is None:
+                continue
+            offsets = [match.start() for match in regex.finditer(content)]
+            if offsets:
+                results.append((path, offsets))
+        return sorted(results)
+
+    def read_content(self, data_id, chunk_size=1 << 20):
+        # Whole content of a file as text, or None if it no longer exists. Read a chunk at a time,
+        # so writers to the file only wait for one chunk (a concurrent write may show up partially).
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        parts = []
+        position = 0
+        while True:
+            with self.lock.shared():
+                if data_id not in self.memory_map:
+                    return None
+                with self.file_lock(data_id):
+                    chunk = self.memory_map.read(data_id, position, chunk_size)
+            if not chunk:
+                break
+            position += len(chunk)
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", True))
+        return "".join(parts)
+
+    def largest_dirs(self, count=10, dir_path=None):
+        # Report of the directories holding the most bytes under dir_path
+        with self.lock.shared():
+            full_path = self.get_full_path(dir_path or self.current_dir)
+            directory = self.get_directory(full_path)
+            if not directory:
+                return "Directory does not exist"
+            found = []
+            stack = [(full_path, directory)]
+            while stack:
+                path, node = stack.pop()
+                found.append((node.total_bytes, node.total_files, path))
+                for name, info in node.contents.items():
+                    if info.type == "directory":
+                        stack.append((os.path.join(path, name).replace("\\", "/"), info))
+            result = f"Largest directories under {full_path}:\n"
+            for nbytes, files, path in heapq.nlargest(count, found):
+                result += f"{nbytes:>12} bytes {files:>8} files  {path}\n"
+            return result
+
+    def import_tree(self, host_path, dest, workers=8, chunk_size=1 << 20):
+        # Copies a host file or directory tree to dest, merging into directories that already
+        # exist and replacing files. Directories are created as the host tree is walked, files
+        # are streamed in by a pool of workers, and the journal is flushed once at the end.
+        if not os.path.exists(host_path):
+            return "Host path does not exist"
+        full_path = self.get_full_path(dest)
+        errors = []
+        dirs = 0
+
+        def jobs():
+            nonlocal dirs
+            if not os.path.isdir(host_path):
+                yield host_path, full_path, 0
+                return
+            for root, dirnames, filenames in os.walk(host_path):
+                dirnames.sort()
+                rel = os.path.relpath(root, host_path)
+                target = full_path if rel == "." else os.path.join(full_path, rel).replace("\\", "/")
+                with self.lock.shared():
+                    exists = self.get_directory(target) is not None
+                if not exists:
+                    result = self.mkdir(target)
+                    if result != f"Directory {target} created":
+                        errors.append(f"{target}: {result}")
+                        dirnames.clear()  # Nothing beneath it can be imported
+                        continue
+                    dirs += 1
+                for name in sorted(filenames):
+                    source = os.path.join(root, name)
+                    try:
+                        info = os.stat(source)
+                    except OSError as exc:
+                        errors.append(f"{source}: {exc.strerror or exc}")
+                        continue
+                    if stat.S_ISREG(info.st_mode):
+                        yield source, os.path.join(target, name).replace("\\", "/"), info.st_size
+
+        with self.batch():
+            files, nbytes = self.transfer(jobs(), self.import_file, workers, chunk_size, errors)
+        return "\n".join([f"Imported {files} files, {dirs} directories ({nbytes} bytes) to {dest}"
+                          + (f", {len(errors)} failed:" if errors else "")] + errors)
+
+    def export_tree(self, src, host_path, workers=8, chunk_size=1 << 20):
+        # Copies a file or directory tree out to host_path, creating host directories as needed
+        # and overwriting host files; files are streamed out by a pool of workers
+        full_path = self.get_full_path(src)
+        with self.lock.shared():
+            is_dir = self.get_directory(full_path) is not None
+            parent = self.get_directory(os.path.dirname(full_path))
+            node = parent.contents.get(os.path.basename(full_path)) if parent else None
+        if not is_dir and node is None:
+            return "File/directory does not exist"
+        errors = []
+        dirs = 0
+
+        def jobs():
+            nonlocal dirs
+            if not is_dir:
+                yield full_path, host_path, 0
+                return
+            for path, dirnames, filenames in self.walk(full_path):
+                rel = path[len(full_path):].strip("/")
+                parts = rel.split("/") if rel else []
+                if any(part in (".", "..") or os.sep in part or (os.altsep and os.altsep in part)
+                       for part in parts + filenames):
+                    # Names the host would read as a different path are never written out
+                    errors.append(f"{path}: Name not valid on the host")
+                    dirnames.clear()
+                    continue
+                target = os.path.join(host_path, *parts)
+                try:
+                    os.makedirs(target, exist_ok=True)
+                except OSError as exc:
+                    errors.append(f"{path}: {exc.strerror or exc}")
+                    dirnames.clear()
+                    continue
+                dirs += 1
+                for entry in self.scandir(path):
+                    if entry.type == "file":
+                        yield entry.path, os.path.join(target, entry.name), entry.size
+
+        # Handles are closed inside a batch so that closing them doesn't sync the journal each time
+        with self.batch():
+            files, nbytes = self.transfer(jobs(), self.export_file, workers, chunk_size, errors)
+        return "\n".join([f"Exported {files} files, {dirs} directories ({nbytes} bytes) to {host_path}"
+                          + (f", {len(errors)} failed:" if errors else "")] + errors)
+
+    def transfer(self, jobs, copy, workers, chunk_size, errors):
+        # Runs copy(source, target, chunk_size) for each (source, target, size) job on a pool.
+        # Small files are handed over in groups of up to chunk_size bytes, since a pool round
+        # trip costs more than copying one of them, and only a bounded number of groups is in
+        # flight so huge trees aren't queued up front. Returns (files, bytes) copied; failures
+        # are appended to errors as "source: error".
+        files = nbytes = 0
+        pending = deque()
+
+        def copy_group(group):
+            results = []
+            for source, target in group:
+                try:
+                    copied, error = copy(source, target, chunk_size)
+                except OSError as exc:
+                    copied, error = 0, exc.strerror or str(exc)
+                results.append((source, copied, error))
+            return results
+
+        def collect():
+            nonlocal files, nbytes
+            for source, copied, error in pending.popleft().result():
+                if error:
+                    errors.append(f"{source}: {error}")
+                else:
+                    files += 1
+                    nbytes += copied
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fs-transfer") as pool:
+            group = []
+            group_bytes = 0
+            for source, target, size in jobs:
+                group.append((source, target))
+                group_bytes += size
+                if group_bytes >= chunk_size or len(group) >= 256:
+                    pending.append(pool.submit(copy_group, group))
+                    group = []
+                    group_bytes = 0
+                    if len(pending) > workers * 2:
+                        collect()
+            if group:
+                pending.append(pool.submit(copy_group, group))
+            while pending:
+                collect()
+        return files, nbytes
+
+    def import_file(self, host_file, path, chunk_size):
+        # Streams a host file into path; returns (bytes written, error or None)
+        with open(host_file, "rb") as source:
+            small = os.fstat(source.fileno()).st_size < chunk_size
+            file_obj, result = self.open(path, "wb")
+            if file_obj is None:
+                return 0, result
+            try:
+                if small:
+                    # Read and written in one go; larger files are streamed a chunk at a time
+                    data = source.read()
+                    result = file_obj.write_to_file(data)
+                    nbytes = len(data)
+                else:
+                    result = file_obj.write_stream(iter(lambda: source.read(chunk_size), b""))
+                    nbytes = file_obj.position
+                return nbytes, None if result == "Write successful" else result
+            finally:
+                self.close(file_obj)
+
+    def export_file(self, path, host_file, chunk_size):
+        # Streams a file out to a host file; returns (bytes written, error or None)
+        file_obj, result = self.open(path, "rb")
+        if file_obj is None:
+            return 0, result
+        try:
+            with open(host_file, "wb") as target:
+                for chunk in file_obj.iter_chunks(chunk_size):
+                    target.write(chunk)
+            return file_obj.position, None
+        finally:
+            self.close(file_obj)
 
     def get_directory(self, path):
         if path == "/":
             return self.fs_structure["/"]
-        parts = path.strip("/").split("/")
+        key = path.strip("/")
+        with self.cache_lock:
+            current = self.dir_cache.get(key)
+            if current is not None:
+                self.dir_cache.move_to_end(key)
+                return current
+        parts = key.split("/")
         current = self.fs_structure["/"]
         for part in parts:
-            if part not in current["contents"] or current["contents"][part]["type"] != "directory":
+            current = current.contents.get(part)
+            if current is None or current.type != "directory":
                 return None
-            current = current["contents"][part]
+        # Only hits are cached, so creating new entries (mkdir/create) never leaves a stale result behind
+        with self.cache_lock:
+            self.dir_cache[key] = current
+            if len(self.dir_cache) > self.dir_cache_size:
+                self.dir_cache.popitem(last=False)
         return current
 
+    def is_dir(self, path):
+        # Locked counterpart of get_directory for callers that don't hold self.lock
+        with self.lock.shared():
+            return self.get_directory(self.get_full_path(path)) is not None
+
+    def invalidate_dirs(self, path):
+        # Drops a directory and every cached path beneath it, after it is deleted or moved
+        key = path.strip("/")
+        prefix = key + "/"
+        with self.cache_lock:
+            for cached in [k for k in self.dir_cache if k == key or k.startswith(prefix)]:
+                del self.dir_cache[cached]
+
     def open(self, fName, mode):
-        full_path = self.get_full_path(fName)
-        parent_path = os.path.dirname(full_path)
-        fname = os.path.basename(full_path)
-
-        parent = self.get_directory(parent_path)
-        if not parent:
-            return None, "Parent directory does not exist"
-
-        if fname not in parent["contents"] or parent["contents"][fname]["type"] != "file":
-            if mode in ["w", "a"]:
-                result = self.create(fName)
-                if "created" not in result:
-                    return None, result
-                parent = self.get_directory(parent_path)  # Refresh parent
-            else:
-                return None, "File does not exist"
+        with self.lock.exclusive():
+            full_path = self.get_full_path(fName)
+            parent_path = os.path.dirname(full_path)
+            fname = os.path.basename(full_path)
+
+            parent = self.get_directory(parent_path)
+            if not parent:
+                return None, "Parent directory does not exist"
+
+            if fname not in parent.contents or parent.contents[fname].type != "file":
+                if mode.replace("b", "") in ["w", "a"]:
+                    result = self.create(fName)
+                    if "created" not in result:
+                        return None, result
+                    parent = self.get_directory(parent_path)  # Refresh parent
+                else:
+                    return None, "File does not exist"
+
+            file_obj = FileObject(self, parent.contents[fname].inode, mode, full_path, self.next_fd)
+            self.next_fd += 1
+            self.open_files[file_obj.fd] = file_obj
+            self.open_counts[file_obj.data_id] = self.open_counts.get(file_obj.data_id, 0) + 1
+            return file_obj, f"File {fName} opened in {mode} mode"
 
-        file_obj = FileObject(self, parent["contents"][fname]["data_id"], mode, full_path)
-        self.open_files[full_path] = file_obj
-        return file_obj, f"File {fName} opened in {mode} mode"
+    def get_handle(self, fd):
+        return self.open_files.get(fd)
 
-    def close(self, fName):
-        full_path = self.get_full_path(fName)
-        if full_path in self.open_files:
-            del self.open_files[full_path]
-            self.save_data()
-            return f"File {fName} closed"
-        return "File not open"
+    def find_handle(self, target):
+        # Open FileObject for a descriptor, a FileObject or a path (the newest handle on that file)
+        if isinstance(target, FileObject):
+            return target if self.open_files.get(target.fd) is target else None
+        if isinstance(target, int):
+            return self.open_files.get(target)
+        full_path = self.get_full_path(target)
+        parent = self.get_directory(os.path.dirname(full_path))
+        node = parent.contents.get(os.path.basename(full_path)) if parent else None
+        for file_obj in reversed(self.open_files.values()):
+            if (file_obj.data_id == node.inode) if node is not None else (file_obj.full_path == full_path):
+                return file_obj
+        return None
+
+    def close(self, target):
+        # Closes one handle (see find_handle). Several handles may be open on a file at once;
+        # its content is made durable when the last of them is closed.
+        with self.lock.exclusive():
+            file_obj = self.find_handle(target)
+            if file_obj is None:
+                return "File not open"
+            del self.open_files[file_obj.fd]
+            file_obj.fd = None
+            remaining = self.open_counts.pop(file_obj.data_id) - 1
+            if remaining:
+                self.open_counts[file_obj.data_id] = remaining
+            elif self.durability != "immediate" and not self.batch_depth:
+                self.flush()
+            return f"File {target if isinstance(target, str) else file_obj.full_path} closed"
 
     def show_memory_map(self):
-        result = "Memory Map:\n"
-        
-        def find_file_path(data_id, current_path="/", current_dir=None):
-            if current_dir is None:
-                current_dir = self.fs_structure["/"]
-            
-            for name, info in current_dir["contents"].items():
-                full_path = os.path.join(current_path, name).replace("\\", "/")
-                if info["type"] == "file" and info["data_id"] == data_id:
-                    return full_path
-                elif info["type"] == "directory":
-                    sub_result = find_file_path(data_id, full_path, info)
-                    if sub_result:
-                        return sub_result
-            return None
+        with self.lock.shared():
+            result = "Memory Map:\n"
+            store = self.memory_map
+            result += (f"Block size: {store.block_size} bytes, "
+                       f"{len(store.blocks) - len(store.free)} blocks allocated, {len(store.free)} free\n")
+            logical, physical = store.usage()
+            result += f"Logical size: {logical} bytes, physical size: {physical} bytes"
+            if physical:
+                result += f" ({logical / physical:.2f}x)"
+            result += "\n"
+            for data_id in store:
+                file_path = self.data_paths.get(data_id, "<not found>")
+                blocks = store.files[data_id]
+                if data_id in store.mapped:
+                    placement = "mapped from image"
+                else:
+                    placement = f"in {len(blocks)} blocks [{format_block_runs(blocks)}]"
+                    shared = sum(1 for block in blocks if store.refs[block] > 1)
+                    if shared:
+                        placement += f", {shared} shared"
+                result += f"Data {data_id}: {store.length(data_id)} bytes {placement} (File: {file_path})\n"
+        
+            return result
+
+    def owner_of(self, data_id):
+        return self.data_paths.get(data_id)
+
+    def block_owner(self, block):
+        with self.lock.shared():
+            # Path of a file holding a block number, or None for free/unknown blocks
+            return self.data_paths.get(self.memory_map.owner(block))
 
-        for data_id, content in self.memory_map.items():
-            file_path = find_file_path(data_id)
-            if file_path:
-                result += f"Block {data_id}: {len(content)} bytes (File: {file_path})\n"
+    def scandir(self, dir_path=None, sort="name", reverse=False, prefix=None, after=None, limit=None):
+        # Yields DirEntry objects for a directory (nothing if it doesn't exist).
+        # sort: "name", "size", "created" (ties broken by name) or None for creation (inode) order,
+        # where a moved entry keeps its place. prefix keeps only names starting with it; after
+        # resumes behind the last DirEntry of the previous page (or the name of an entry that still
+        # exists) and limit caps the page. The cursor's sort key is taken from the DirEntry itself,
+        # so paging carries on correctly when that entry is deleted between pages. A page costs one
+        # pass over the names plus O(limit log limit), and entries are built a batch at a time as
+        # they are consumed.
+        if sort not in ("name", "size", "created", None):
+            raise ValueError(f"Unknown sort order: {sort}")
+
+        def key(name, node):
+            if sort is None:
+                return node.inode, name
+            if sort == "created":
+                return node.created, name
+            return (node.size if node.type == "file" else node.total_bytes), name
+
+        with self.lock.shared():
+            full_path = self.get_full_path(dir_path or self.current_dir)
+            directory = self.get_directory(full_path)
+            if not directory:
+                return
+            contents = directory.contents
+            names = [name for name in contents if name.startswith(prefix)] if prefix else list(contents)
+            keyed = names if sort == "name" else [key(name, contents[name]) for name in names]
+            if isinstance(after, DirEntry):
+                cursor = after.name if sort == "name" else (
+                    after.inode if sort is None else getattr(after, sort), after.name)
+            elif after is not None and (sort == "name" or after in contents):
+                cursor = after if sort == "name" else key(after, contents[after])
             else:
-                result += f"Block {data_id}: {len(content)} bytes (File: <not found>)\n"
-        
-        return result
+                cursor = None
+            if cursor is not None:
+                keyed = [k for k in keyed if (k < cursor if reverse else k > cursor)]
+            if limit is not None:
+                keyed = (heapq.nlargest if reverse else heapq.nsmallest)(limit, keyed)
+            else:
+                keyed.sort(reverse=reverse)
+            names = keyed if sort == "name" else [name for _, name in keyed]
+        for start in range(0, len(names), 1024):
+            with self.lock.shared():
+                batch = [(name, contents.get(name)) for name in names[start:start + 1024]]
+            for name, node in batch:
+                if node is not None:  # Skips entries removed since the page was planned
+                    yield DirEntry(name, os.path.join(full_path, name).replace("\\", "/"), node)
 
     def list_dir(self, dir_path=None):
-        if dir_path is None:
-            dir_path = self.current_dir
-        full_path = self.get_full_path(dir_path)
-        directory = self.get_directory(full_path)
-        if not directory or directory["type"] != "directory":
-            return "Directory does not exist"
-        
-        result = f"Contents of {full_path}:\n"
-        for name, info in directory["contents"].items():
-            item_type = info["type"].capitalize()
-            created = info["created"]
-            size = info.get("size", 0) if info["type"] == "file" else "-"
-            result += f"{item_type:<10} {name:<20} Size: {size:<10} Created: {created}\n"
-        return result
+        with self.lock.shared():
+            if dir_path is None:
+                dir_path = self.current_dir
+            full_path = self.get_full_path(dir_path)
+            directory = self.get_directory(full_path)
+            if not directory or directory.type != "directory":
+                return "Directory does not exist"
+        
+            result = f"Contents of {full_path}:\n"
+            if directory.quota is not None:
+                max_bytes, max_inodes = directory.quota
+                result += (f"Quota: {directory.total_bytes}/{max_bytes if max_bytes is not None else '-'} bytes, "
+                           f"{directory.total_files + directory.total_dirs}/"
+                           f"{max_inodes if max_inodes is not None else '-'} inodes\n")
+            lines = [result]
+            for entry in self.scandir(full_path, sort=None):
+                item_type = entry.type.capitalize()
+                created = format_time(entry.created)
+                lines.append(f"{item_type:<10} {entry.name:<20} Size: {entry.size:<10} Created: {created}\n")
+            return "".join(lines)
+
+def clip_range(start, size, length):
+    # Resolves read_from_file's optional start/size into a (start, end) range, or None when empty
+    if start is None:
+        return 0, length
+    start = max(0, int(start))
+    if start >= length:
+        return None  # Nothing to read beyond content length
+    if size is None:
+        return start, length
+    size = int(size)
+    if size <= 0:
+        return None
+    return start, min(start + size, length)
 
 class FileObject:
-    def __init__(self, fs, data_id, mode, full_path):
+    # Text modes ("r", "w", "a") take and return str with character offsets; binary modes
+    # ("rb", "wb", "ab") take and return bytes with byte offsets. Content is stored as bytes.
+    def __init__(self, fs, data_id, mode, full_path, fd=None):
         self.fs = fs
         self.data_id = data_id
-        self.mode = mode
+        self.binary = "b" in mode
+        self.mode = mode.replace("b", "")
         self.full_path = full_path
+        self.fd = fd  # Descriptor in fs.open_files, None once closed
+        self.position = 0  # Byte cursor used by the streaming methods (seek/tell/readinto/iter_chunks)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        return self.fs.close(self)
+
+    def exists(self):
+        # False once the content is gone: the file was deleted or its creation rolled back.
+        # Writes then fail and reads come back empty.
+        return self.data_id in self.fs.memory_map
+
+    def byte_addressed(self):
+        # Character offsets only differ from byte offsets for text handles on non-ASCII content
+        return self.binary or self.fs.memory_map.is_ascii(self.data_id)
+
+    def check_growth(self, growth):
+        # Quota/capacity error for growing this file by growth bytes, or None
+        path = self.fs.data_paths.get(self.data_id)
+        if growth <= 0 or path is None:
+            return None
+        return self.fs.check_space(os.path.dirname(path), growth, 0)
 
-    def write_to_file(self, text, write_at=None):
+    def write_to_file(self, data, write_at=None):
         if self.mode not in ["w", "a"]:
             return "Invalid mode for writing"
-        content = self.fs.memory_map[self.data_id]
-        if self.mode == "w" and write_at is None:
-            content = text  # Overwrite entire content in write mode
-        elif write_at is None:
-            content += text  # Append text in append mode
+        if write_at is not None and write_at < 0:
+            return "Invalid write position"
+        if self.binary and isinstance(data, (bytes, bytearray, memoryview)):
+            data = payload = bytes(data)  # Blocks must not alias a buffer the caller may change
+        elif not self.binary and isinstance(data, str):
+            payload = data.encode("utf-8")
         else:
-            content = content[:write_at] + text + content[write_at + len(text):]  # Write at specific position
-        self.fs.memory_map[self.data_id] = content
-        
-        # Update file size in fs_structure
-        parent_path = os.path.dirname(self.full_path)
-        fname = os.path.basename(self.full_path)
-        parent = self.fs.get_directory(parent_path)
-        if parent and fname in parent["contents"]:
-            parent["contents"][fname]["size"] = len(content)
-        
-        self.fs.save_data()
+            return "Invalid data type"
+        with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+            if not self.exists():
+                return "File does not exist"
+            length = self.fs.memory_map.length(self.data_id)
+            record = {"op": "bwrite", "id": self.data_id}
+            if self.mode == "w" and write_at is None:
+                record.update(at=0, trunc=True)  # Overwrite entire content in write mode
+            elif write_at is None:
+                record["at"] = length  # Append data in append mode
+            else:
+                # Write at specific position, overwriting as many characters/bytes as are written
+                if self.byte_addressed():
+                    at, end = min(write_at, length), min(write_at + len(data), length)
+                else:
+                    store = self.fs.memory_map
+                    at, end = (store.char_offset(self.data_id, i) for i in (write_at, write_at + len(data)))
+                if end - at == len(payload):
+                    record["at"] = at
+                elif end == length:
+                    record.update(at=at, trunc=True)
+                else:
+                    record.update(op="bsplice", at=at, cut=end - at)
+            if record["op"] == "bsplice":
+                growth = len(payload) - record["cut"]
+            elif record.get("trunc"):
+                growth = record["at"] + len(payload) - length
+            else:
+                growth = max(length, record["at"] + len(payload)) - length
+            error = self.check_growth(growth)
+            if error:
+                return error
+            self.fs.perform(record, payload)
+        self.fs.checkpoint_if_due()
         return "Write successful"
 
     def read_from_file(self, start=None, size=None):
-        content = self.fs.memory_map[self.data_id]
-        content_length = len(content)
-        
-        if start is None:
-            return content
-        start = max(0, int(start))
-        if start >= content_length:
-            return ""  # Return empty string if start is beyond content length
-        
-        if size is None:
-            return content[start:]
-        size = int(size)
-        if size <= 0:
-            return ""
-        return content[start:min(start + size, content_length)]
+        with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+            store = self.fs.memory_map
+            if not self.exists():
+                return b"" if self.binary else ""
+            if not self.byte_addressed():
+                span = clip_range(start, size, store.char_length(self.data_id))
+                if not span:
+                    return ""
+                at, end = (store.char_offset(self.data_id, i) for i in span)
+                return store.read(self.data_id, at, end - at).decode("utf-8", "replace")
+            span = clip_range(start, size, store.length(self.data_id))
+            data = store.read(self.data_id, span[0], span[1] - span[0]) if span else b""
+            return data if self.binary else data.decode("ascii")
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.fs.memory_map.length(self.data_id)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def iter_chunks(self, chunk_size=65536):
+        # Yields the content from the cursor onwards (str for text handles); locks are only
+        # held while each chunk is read
+        decoder = None if self.binary else codecs.getincrementaldecoder("utf-8")("replace")
+        while True:
+            with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+                chunk = self.fs.memory_map.read(self.data_id, self.position, chunk_size) if self.exists() else b""
+            if not chunk:
+                break
+            self.position += len(chunk)
+            if decoder is None:
+                yield chunk
+            else:
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+        if decoder is not None:
+            tail = decoder.decode(b"", True)
+            if tail:
+                yield tail
+
+    def readinto(self, buffer):
+        # File-like read of raw content into a writable buffer; returns the byte count
+        view = memoryview(buffer).cast("B")
+        with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+            data = self.fs.memory_map.read(self.data_id, self.position, len(view)) if self.exists() else b""
+        view[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def write_stream(self, iterable):
+        # Appends chunk by chunk ("w" mode replaces the content first), persisting once at the end.
+        # Chunks may be str (encoded as UTF-8) or bytes-like.
+        if self.mode not in ["w", "a"]:
+            return "Invalid mode for writing"
+        with self.fs.batch():
+            if self.mode == "w" and self.exists() and self.fs.memory_map.length(self.data_id):
+                self.truncate_file(0)
+            for chunk in iterable:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                elif isinstance(chunk, (bytes, bytearray, memoryview)):
+                    chunk = bytes(chunk)
+                else:
+                    return "Invalid data type"
+                with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+                    error = "File does not exist" if not self.exists() else self.check_growth(len(chunk))
+                    if error:
+                        return error
+                    at = self.fs.memory_map.length(self.data_id)
+                    self.fs.perform({"op": "bwrite", "id": self.data_id, "at": at}, chunk)
+                self.position = at + len(chunk)
+        return "Write successful"
 
     def move_within_file(self, start, size, target):
-        content = self.fs.memory_map[self.data_id]
-        if start < 0 or size < 0 or target < 0 or start + size > len(content):
-            return "Invalid move parameters"
-        data = content[start:start + size]
-        content = content[:start] + content[start + size:]
-        content = content[:target] + data + content[target:]
-        self.fs.memory_map[self.data_id] = content
-        
-        # Update file size
-        parent_path = os.path.dirname(self.full_path)
-        fname = os.path.basename(self.full_path)
-        parent = self.fs.get_directory(parent_path)
-        if parent and fname in parent["contents"]:
-            parent["contents"][fname]["size"] = len(content)
-        
-        self.fs.save_data()
+        with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+            if not self.exists():
+                return "File does not exist"
+            if start < 0 or size < 0 or target < 0:
+                return "Invalid move parameters"
+            if self.byte_addressed():
+                if start + size > self.fs.memory_map.length(self.data_id):
+                    return "Invalid move parameters"
+            else:
+                store = self.fs.memory_map
+                if start + size > store.char_length(self.data_id):
+                    return "Invalid move parameters"
+                # target counts characters of the content without the moved range
+                at, end = store.char_offset(self.data_id, start), store.char_offset(self.data_id, start + size)
+                if target > start:
+                    target = store.char_offset(self.data_id, target + size) - (end - at)
+                else:
+                    target = store.char_offset(self.data_id, target)
+                start, size = at, end - at
+            self.fs.perform({
+                "op": "bshift",
+                "id": self.data_id,
+                "start": start,
+                "size": size,
+                "target": target
+            })
+        self.fs.checkpoint_if_due()
         return "Move successful"
 
     def truncate_file(self, maxSize):
         if maxSize < 0:
             return "Invalid truncate size"
-        content = self.fs.memory_map[self.data_id][:maxSize]
-        self.fs.memory_map[self.data_id] = content
-        
-        # Update file size
-        parent_path = os.path.dirname(self.full_path)
-        fname = os.path.basename(self.full_path)
-        parent = self.fs.get_directory(parent_path)
-        if parent and fname in parent["contents"]:
-            parent["contents"][fname]["size"] = len(content)
-        
-        self.fs.save_data()
+        with self.fs.lock.shared(), self.fs.file_lock(self.data_id):
+            if not self.exists():
+                return "File does not exist"
+            if not self.byte_addressed():
+                maxSize = self.fs.memory_map.char_offset(self.data_id, maxSize)
+            self.fs.perform({"op": "btruncate", "id": self.data_id, "size": maxSize})
+        self.fs.checkpoint_if_due()
         return "Truncate successful"
 
+class AsyncFileSystem:
+    # asyncio facade: operations run on an executor so the event loop never blocks,
+    # and the journal syncs of concurrently finishing mutations are coalesced.
+    def __init__(self, fs=None, executor=None, **kwargs):
+        if fs is None:
+            # Flushing is driven by the coalesced flush() below unless another policy is asked for
+            fs = FileSystem(**dict({"durability": "batch", "batch_size": None}, **kwargs))
+        self.fs = fs  # A FileSystem passed in keeps its own durability policy
+        self.executor = executor
+        self.pending_flush = None
+
+    async def call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def mutate(self, func, *args):
+        # Returns once the mutation is durable
+        result = await self.call(func, *args)
+        await self.flush()
+        return result
+
+    async def flush(self):
+        # Callers arriving while a flush is still queued share it
+        if self.pending_flush is None:
+            self.pending_flush = asyncio.ensure_future(self.run_flush())
+        await asyncio.shield(self.pending_flush)
+
+    async def run_flush(self):
+        await asyncio.sleep(0)  # Let operations finishing in the same loop iteration join
+        self.pending_flush = None
+        await self.call(self.fs.flush)
+
+    async def create(self, fName):
+        return await self.mutate(self.fs.create, fName)
+
+    async def delete(self, fName):
+        return await self.mutate(self.fs.delete, fName)
+
+    async def mkdir(self, dirName):
+        return await self.mutate(self.fs.mkdir, dirName)
+
+    async def copy_tree(self, source_fName, target_fName):
+        return await self.mutate(self.fs.copy_tree, source_fName, target_fName)
+
+    async def set_quota(self, dirName, max_bytes=None, max_inodes=None):
+        return await self.mutate(self.fs.set_quota, dirName, max_bytes, max_inodes)
+
+    async def rmtree(self, dirName):
+        return await self.mutate(self.fs.rmtree, dirName)
+
+    async def du(self, path=None):
+        return await self.call(self.fs.du, path)
+
+    async def find(self, pattern, dir_path=None):
+        return await self.call(self.fs.find, pattern, dir_path)
+
+    async def glob(self, pattern):
+        return await self.call(self.fs.glob, pattern)
+
+    async def search(self, text):
+        return await self.call(self.fs.search, text)
+
+    async def largest_dirs(self, count=10, dir_path=None):
+        return await self.call(self.fs.largest_dirs, count, dir_path)
+
+    async def chdir(self, dirName):
+        return await self.call(self.fs.chdir, dirName)
+
+    async def move(self, source_fName, target_fName):
+        return await self.mutate(self.fs.move, source_fName, target_fName)
+
+    async def open(self, fName, mode):
+        file_obj, result = await self.mutate(self.fs.open, fName, mode)
+        if file_obj is None:
+            return None, result
+        return AsyncFileObject(self, file_obj), result
+
+    async def apply(self, ops):
+        return await self.mutate(self.fs.apply, ops)
+
+    async def import_tree(self, host_path, dest):
+        return await self.mutate(self.fs.import_tree, host_path, dest)
+
+    async def export_tree(self, src, host_path):
+        return await self.call(self.fs.export_tree, src, host_path)
+
+    async def close(self, fName):
+        if isinstance(fName, AsyncFileObject):
+            fName = fName.file_obj
+        return await self.mutate(self.fs.close, fName)
+
+    async def list_dir(self, dir_path=None):
+        return await self.call(self.fs.list_dir, dir_path)
+
+    async def scandir(self, dir_path=None, sort="name", reverse=False, prefix=None, after=None, limit=None):
+        # One page of entries as a list
+        return await self.call(lambda: list(self.fs.scandir(dir_path, sort, reverse, prefix, after, limit)))
+
+    async def show_memory_map(self):
+        return await self.call(self.fs.show_memory_map)
+
+    async def checkpoint(self):
+        return await self.call(self.fs.checkpoint)
+
+class AsyncFileObject:
+    def __init__(self, afs, file_obj):
+        self.afs = afs
+        self.file_obj = file_obj
+
+    def fileno(self):
+        return self.file_obj.fd
+
+    async def close(self):
+        return await self.afs.close(self)
+
+    async def write_to_file(self, text, write_at=None):
+        return await self.afs.mutate(self.file_obj.write_to_file, text, write_at)
+
+    async def read_from_file(self, start=None, size=None):
+        return await self.afs.call(self.file_obj.read_from_file, start, size)
+
+    async def move_within_file(self, start, size, target):
+        return await self.afs.mutate(self.file_obj.move_within_file, start, size, target)
+
+    async def truncate_file(self, maxSize):
+        return await self.afs.mutate(self.file_obj.truncate_file, maxSize)
+
+class FileSystemShell(cmd.Cmd):
+    # Line-oriented front end shared by the REPL, batch mode and one-shot commands (see main).
+    # Arguments are split like a POSIX shell; every command writes its result on stdout.
+    prompt = "fs> "
+
+    def __init__(self, fs, stdout=None):
+        super().__init__(stdout=stdout)
+        self.fs = fs
+        self.failed = False  # Set when a command fails, for the exit status
+
+    def emit(self, text, ok=True):
+        self.stdout.write(text if text.endswith("\n") else text + "\n")
+        if not ok:
+            self.failed = True
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except Exception as exc:
+            self.emit(f"Error: {exc}", False)
+
+    def emptyline(self):
+        pass
+
+    def default(self, line):
+        self.emit(f"Unknown command: {line.split()[0]}", False)
+
+    def parse(self, arg, low, high, usage):
+        try:
+            # Plain words (the common case in generated scripts) skip the slower shlex tokenizer
+            args = shlex.split(arg) if any(c in arg for c in "'\"\\") else arg.split()
+        except ValueError as exc:
+            self.emit(f"Error: {exc}", False)
+            return None
+        if not low <= len(args) <= high:
+            self.emit(f"Usage: {usage}", False)
+            return None
+        return args
+
+    def run_op(self, op, args):
+        # Mutations go through the same table as FileSystem.apply, which also tells success apart
+        min_args, max_args, run, success = TRANSACTION_OPS[op]
+        result = run(self.fs, *args)
+        self.emit(result, result == success.format(*args))
+
+    def do_ls(self, arg):
+        """ls [PATH]: list a directory"""
+        args = self.parse(arg, 0, 1, "ls [PATH]")
+        if args is not None:
+            result = self.fs.list_dir(*args)
+            self.emit(result, result.startswith("Contents of"))
+
+    def do_cd(self, arg):
+        """cd PATH: change the current directory"""
+        args = self.parse(arg, 1, 1, "cd PATH")
+        if args is not None:
+            result = self.fs.chdir(args[0])
+            self.emit(result, result.startswith("Changed to"))
+
+    def do_pwd(self, arg):
+        """pwd: print the current directory"""
+        self.emit(self.fs.current_dir)
+
+    def do_mkdir(self, arg):
+        """mkdir PATH: create a directory"""
+        args = self.parse(arg, 1, 1, "mkdir PATH")
+        if args is not None:
+            self.run_op("mkdir", args)
+
+    def do_touch(self, arg):
+        """touch PATH: create an empty file"""
+        args = self.parse(arg, 1, 1, "touch PATH")
+        if args is not None:
+            self.run_op("create", args)
+
+    def do_rm(self, arg):
+        """rm PATH: delete a file or directory"""
+        args = self.parse(arg, 1, 1, "rm PATH")
+        if args is not None:
+            self.run_op("delete", args)
+
+    def do_rmtree(self, arg):
+        """rmtree PATH: remove a directory and everything beneath it"""
+        args = self.parse(arg, 1, 1, "rmtree PATH")
+        if args is not None:
+            self.run_op("rmtree", args)
+
+    def do_mv(self, arg):
+        """mv SOURCE TARGET: move or rename"""
+        args = self.parse(arg, 2, 2, "mv SOURCE TARGET")
+        if args is not None:
+            self.run_op("move", args)
+
+    def do_cp(self, arg):
+        """cp SOURCE TARGET: copy a file or directory tree"""
+        args = self.parse(arg, 2, 2, "cp SOURCE TARGET")
+        if args is not None:
+            self.run_op("copy", args)
+
+    def do_quota(self, arg):
+        """quota PATH [BYTES|- [INODES|-]]: set or (with no limits) remove a directory quota"""
+        args = self.parse(arg, 1, 3, "quota PATH [BYTES|- [INODES|-]]")
+        if args is not None:
+            self.run_op("quota", [args[0]] + [None if limit == "-" else int(limit) for limit in args[1:]])
+
+    def do_write(self, arg):
+        """write PATH TEXT...: replace the content of a file (created if missing)"""
+        args = self.parse(arg, 2, sys.maxsize, "write PATH TEXT...")
+        if args is not None:
+            self.run_op("write", [args[0], " ".join(args[1:])])
+
+    def do_append(self, arg):
+        """append PATH TEXT...: append to a file (created if missing)"""
+        args = self.parse(arg, 2, sys.maxsize, "append PATH TEXT...")
+        if args is not None:
+            self.run_op("append", [args[0], " ".join(args[1:])])
+
+    def do_truncate(self, arg):
+        """truncate PATH SIZE: cut a file down to SIZE characters"""
+        args = self.parse(arg, 2, 2, "truncate PATH SIZE")
+        if args is not None:
+            self.run_op("truncate", [args[0], int(args[1])])
+
+    def do_cat(self, arg):
+        """cat PATH: print the content of a file"""
+        args = self.parse(arg, 1, 1, "cat PATH")
+        if args is None:
+            return
+        file_obj, result = self.fs.open(args[0], "r")
+        if file_obj is None:
+            self.emit(result, False)
+            return
+        try:
+            last = "\n"
+            for chunk in file_obj.iter_chunks():
+                self.stdout.write(chunk)
+                last = chunk
+            if not last.endswith("\n"):
+                self.stdout.write("\n")
+        finally:
+            self.fs.close(file_obj)
+
+    def do_import(self, arg):
+        """import HOST_PATH PATH: copy a host file or directory tree (- for stdin) into the file system"""
+        args = self.parse(arg, 2, 2, "import HOST_PATH PATH")
+        if args is None:
+            return
+        if args[0] != "-":
+            result = self.fs.import_tree(args[0], args[1])
+            self.emit(result, result.startswith("Imported") and "\n" not in result)
+            return
+        source = sys.stdin.buffer
+        result = edit_file(self.fs, args[1], "wb", lambda f: f.write_stream(iter(lambda: source.read(65536), b"")))
+        self.emit(result, result == "Write successful")
+
+    def do_export(self, arg):
+        """export PATH HOST_PATH: copy a file or directory tree out to the host (- for stdout)"""
+        args = self.parse(arg, 2, 2, "export PATH HOST_PATH")
+        if args is None:
+            return
+        if args[1] != "-":
+            result = self.fs.export_tree(args[0], args[1])
+            self.emit(result, result.startswith("Exported") and "\n" not in result)
+            return
+        file_obj, result = self.fs.open(args[0], "rb")
+        if file_obj is None:
+            self.emit(result, False)
+            return
+        try:
+            self.stdout.flush()
+            for chunk in file_obj.iter_chunks():
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        finally:
+            self.fs.close(file_obj)
+
+    def do_find(self, arg):
+        """find PATTERN [DIR]: paths of entries whose name matches a glob pattern"""
+        args = self.parse(arg, 1, 2, "find PATTERN [DIR]")
+        if args is not None:
+            for path in self.fs.find(*args):
+                self.emit(path)
+
+    def do_glob(self, arg):
+        """glob PATTERN: paths matching a glob over full paths (** spans directories)"""
+        args = self.parse(arg, 1, 1, "glob PATTERN")
+        if args is not None:
+            for path in self.fs.glob(args[0]):
+                self.emit(path)
+
+    def do_search(self, arg):
+        """search TEXT...: files containing the words, with character offsets"""
+        args = self.parse(arg, 1, sys.maxsize, "search TEXT...")
+        if args is not None:
+            for path, offsets in self.fs.search(" ".join(args)):
+                self.emit(f"{path}: {' '.join(map(str, offsets))}")
+
+    def do_du(self, arg):
+        """du [PATH]: content bytes of a file or directory tree"""
+        args = self.parse(arg, 0, 1, "du [PATH]")
+        if args is not None:
+            nbytes = self.fs.du(*args)
+            if nbytes is None:
+                self.emit("File/directory does not exist", False)
+            else:
+                self.emit(str(nbytes))
+
+    def do_map(self, arg):
+        """map: show the memory map"""
+        self.emit(self.fs.show_memory_map())
+
+    def do_flush(self, arg):
+        """flush: make every logged change durable"""
+        self.emit(self.fs.flush())
+
+    def do_checkpoint(self, arg):
+        """checkpoint: write a new image and start a fresh journal"""
+        self.emit(self.fs.checkpoint())
+
+    def do_exit(self, arg):
+        """exit: leave the shell"""
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, arg):
+        if self.prompt:
+            self.stdout.write("\n")
+        return True
+
 class FileSystemGUI:
-    def __init__(self, root):
-        self.fs = FileSystem()
+    def __init__(self, root, fs=None):
+        load_tk()
+        self.fs = fs if fs is not None else FileSystem()
         self.root = root
+        # File system calls run on workers so the Tk main loop never blocks on them
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="fs-gui")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fs-gui-writer")
+        self.poll_interval = 16  # ms between checks on a running task, about one frame at 60 fps
+        self.long_task = None  # Long operation the Cancel button applies to
+        self.cancelled = set()
+        self.handles = {}  # (full path, mode) -> FileObject kept open across file actions
+        self.handles_lock = threading.Lock()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.root.title("Distributed File Management System")
         self.root.geometry("1000x700")
         self.root.configure(bg="#f5f5f5")
@@ -372,6 +3109,31 @@ class FileSystemGUI:
             style="Accent.TButton"
         ).grid(row=3, column=0, columnspan=2, pady=10)
         
+        # Directory Listing Tab: rows are fetched a page at a time as the view scrolls
+        self.listing_tab = ttk.Frame(self.notebook)
+        self.notebook.add(self.listing_tab, text="Directory Listing")
+        self.listing = ttk.Treeview(self.listing_tab, columns=("type", "size", "created"))
+        self.listing.heading("#0", text="Name")
+        self.listing.heading("type", text="Type")
+        self.listing.heading("size", text="Size")
+        self.listing.heading("created", text="Created")
+        self.listing.column("type", width=90)
+        self.listing.column("size", width=100, anchor=tk.E)
+        listing_scrollbar = ttk.Scrollbar(self.listing_tab, command=self.listing.yview)
+        listing_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listing.pack(fill=tk.BOTH, expand=True)
+        self.listing.config(yscrollcommand=lambda first, last: self.on_listing_scroll(listing_scrollbar, first, last))
+        self.listing_path = None
+        # Only a window of listing_window pages is kept in the widget: scrolling near either edge
+        # loads the next page on that side (the edge rows are the scandir cursors) and drops the
+        # page furthest away, so huge directories never fill the Treeview
+        self.listing_rows = []  # DirEntry per row in the widget, top to bottom
+        self.listing_at_start = True  # The window begins at the first entry
+        self.listing_done = True  # The window ends at the last entry
+        self.listing_loading = False
+        self.listing_page_size = 200
+        self.listing_window = 3
+
         # File Content Tab
         self.file_content_tab = ttk.Frame(self.notebook)
         self.notebook.add(self.file_content_tab, text="File Content")
@@ -472,6 +3234,17 @@ class FileSystemGUI:
         self.truncate_size.grid(row=5, column=1, padx=5, pady=5, sticky=tk.W)
         ttk.Button(advanced_frame, text="Truncate", command=self.truncate_file).grid(
             row=6, column=0, columnspan=2, pady=5)
+
+        # Full-text search over every file
+        search_frame = ttk.LabelFrame(
+            self.file_content_frame,
+            text="Search File Contents",
+            padding=(10, 5)
+        )
+        search_frame.grid(row=6, column=0, columnspan=2, sticky=tk.W+tk.E, pady=10)
+        self.search_text = ttk.Entry(search_frame, width=40)
+        self.search_text.grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        ttk.Button(search_frame, text="Search", command=self.search_files).grid(row=0, column=1, padx=5, pady=5)
         
         # Output console
         console_frame = ttk.LabelFrame(
@@ -499,15 +3272,21 @@ class FileSystemGUI:
         self.output_text.config(yscrollcommand=scrollbar.set)
         scrollbar.config(command=self.output_text.yview)
         
-        # Status bar
+        # Status bar, with progress and cancellation for long operations
+        status_frame = ttk.Frame(self.main_container)
+        status_frame.pack(fill=tk.X)
         self.status_bar = ttk.Label(
-            self.main_container, 
+            status_frame,
             text="Ready",
             relief=tk.SUNKEN,
             anchor=tk.W,
             padding=(10, 5)
         )
-        self.status_bar.pack(fill=tk.X)
+        self.status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.cancel_button = ttk.Button(status_frame, text="Cancel", command=self.cancel_task, state="disabled")
+        self.cancel_button.pack(side=tk.RIGHT, padx=(5, 0))
+        self.progress = ttk.Progressbar(status_frame, mode="indeterminate", length=150)
+        self.progress.pack(side=tk.RIGHT, padx=(5, 0))
         
         # Create an accent style for important buttons
         self.style.configure("Accent.TButton", background="#4a90e2", foreground="white")
@@ -517,106 +3296,201 @@ class FileSystemGUI:
         
     def update_status(self, message):
         self.status_bar.config(text=message)
-        
+
+    def run_task(self, label, work, done, long=False, writer=False):
+        # Runs work() off the Tk thread and done(result) back on it. Mutations go through the
+        # single writer thread so they apply in click order; reads use the pool. Long operations
+        # show the progress bar and can be cancelled, which drops their result.
+        future = (self.writer if writer else self.executor).submit(work)
+        self.update_status(f"{label}...")
+        if long:
+            self.long_task = future
+            self.progress.start(15)
+            self.cancel_button.state(["!disabled"])
+        self.root.after(self.poll_interval, self.poll_task, future, label, done, long)
+
+    def poll_task(self, future, label, done, long):
+        # Checked every frame (~60 fps) so the main loop is never blocked waiting on a worker
+        if not future.done():
+            self.root.after(self.poll_interval, self.poll_task, future, label, done, long)
+            return
+        if long and self.long_task is future:
+            self.long_task = None
+            self.progress.stop()
+            self.cancel_button.state(["disabled"])
+        if future.cancelled() or future in self.cancelled:
+            self.cancelled.discard(future)
+            self.update_status(f"{label} cancelled")
+            return
+        error = future.exception()
+        if error is not None:
+            self.update_status(f"Error: {error}")
+            messagebox.showerror("Error", str(error))
+            return
+        done(future.result())
+
+    def cancel_task(self):
+        future = self.long_task
+        if future is None:
+            return
+        # A queued task never starts; one already running finishes, but its result is discarded
+        future.cancel()
+        self.cancelled.add(future)
+        self.long_task = None
+        self.progress.stop()
+        self.cancel_button.state(["disabled"])
+        self.update_status("Cancelling...")
+
+    def on_close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.writer.submit(self.close_handles)
+        self.writer.shutdown(wait=True)  # Let queued mutations reach the journal
+        self.root.destroy()
+
+    def show_result(self, result, status):
+        # Common completion for simple namespace operations
+        self.output_text.insert(tk.END, result + "\n")
+        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
+        self.update_status(status)
+        messagebox.showinfo("Success", result)
+
     def create_file(self):
         name = self.name_entry.get()
         if not name:
             self.update_status("Error: Please enter a file name")
             messagebox.showerror("Error", "Please enter a file name")
             return
-            
-        result = self.fs.create(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("File created successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        self.run_task("Creating file", lambda: self.fs.create(name),
+                      lambda result: self.show_result(result, "File created successfully"), writer=True)
+
     def create_dir(self):
         name = self.name_entry.get()
         if not name:
             self.update_status("Error: Please enter a directory name")
             messagebox.showerror("Error", "Please enter a directory name")
             return
-            
-        result = self.fs.mkdir(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("Directory created successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        self.run_task("Creating directory", lambda: self.fs.mkdir(name),
+                      lambda result: self.show_result(result, "Directory created successfully"), writer=True)
+
     def delete(self):
         name = self.name_entry.get()
         if not name:
             self.update_status("Error: Please enter a file/directory name")
             messagebox.showerror("Error", "Please enter a file/directory name")
             return
-            
-        result = self.fs.delete(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("File/directory deleted successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        self.run_task("Deleting", lambda: self.fs.delete(name),
+                      lambda result: self.show_result(result, "File/directory deleted successfully"), writer=True)
+
     def change_dir(self):
         name = self.name_entry.get()
         if not name:
             self.update_status("Error: Please enter a directory name")
             messagebox.showerror("Error", "Please enter a directory name")
             return
-            
-        result = self.fs.chdir(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("Directory changed successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        self.run_task("Changing directory", lambda: self.fs.chdir(name),
+                      lambda result: self.show_result(result, "Directory changed successfully"), writer=True)
+
     def move_file(self):
         source = self.name_entry.get()
         target = self.target_entry.get()
-        
+
         if not source or not target:
             self.update_status("Error: Please enter both source and target paths")
             messagebox.showerror("Error", "Please enter both source and target paths")
             return
-            
-        result = self.fs.move(source, target)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("File/directory moved successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        self.run_task("Moving", lambda: self.fs.move(source, target),
+                      lambda result: self.show_result(result, "File/directory moved successfully"), writer=True)
+
     def open_file(self):
         name = self.file_name_entry.get()
         if not name:
             self.update_status("Error: Please enter a file name")
             messagebox.showerror("Error", "Please enter a file name")
             return
-            
+
         mode = self.mode_var.get()
-        file_obj, result = self.fs.open(name, mode)
-        if file_obj:
-            self.output_text.insert(tk.END, result + "\n")
-            self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-            self.update_status(f"File opened in {mode} mode")
-            messagebox.showinfo("Success", result)
-        else:
+
+        def done(opened):
+            file_obj, result = opened
             self.output_text.insert(tk.END, result + "\n")
-            self.update_status("Error: Could not open file")
-            messagebox.showerror("Error", result)
-        
+            if file_obj:
+                self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
+                self.update_status(f"File opened in {mode} mode")
+                messagebox.showinfo("Success", result)
+            else:
+                self.update_status("Error: Could not open file")
+                messagebox.showerror("Error", result)
+
+        self.run_task("Opening file", lambda: self.handle_for(name, mode), done, writer=True)
+
     def close_file(self):
         name = self.file_name_entry.get()
         if not name:
             self.update_status("Error: Please enter a file name")
             messagebox.showerror("Error", "Please enter a file name")
             return
-            
-        result = self.fs.close(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.current_dir_label.config(text=f"Current Directory: {self.fs.current_dir}")
-        self.update_status("File closed successfully")
-        messagebox.showinfo("Success", result)
-        
+
+        def work():
+            with self.handles_lock:
+                full_path = self.fs.get_full_path(name)
+                handles = [self.handles.pop(key) for key in list(self.handles) if key[0] == full_path]
+            if not handles:
+                return self.fs.close(name)
+            for file_obj in handles:
+                self.fs.close(file_obj)
+            return f"File {name} closed"
+
+        self.run_task("Closing file", work,
+                      lambda result: self.show_result(result, "File closed successfully"), writer=True)
+
+    def handle_for(self, name, mode):
+        # Open handle on name in mode, opened on first use and reused by later actions
+        # until the file is closed; returns (file_obj, message) like FileSystem.open
+        with self.handles_lock:
+            full_path = self.fs.get_full_path(name)
+            file_obj = self.handles.get((full_path, mode))
+            if file_obj is not None:
+                if self.fs.get_handle(file_obj.fd) is file_obj and self.fs.owner_of(file_obj.data_id) == full_path:
+                    return file_obj, f"File {name} already open in {mode} mode"
+                self.fs.close(file_obj)  # Closed elsewhere, or the file was deleted or moved away
+                del self.handles[(full_path, mode)]
+            file_obj, result = self.fs.open(name, mode)
+            if file_obj:
+                self.handles[(full_path, mode)] = file_obj
+            return file_obj, result
+
+    def close_handles(self):
+        with self.handles_lock:
+            handles = list(self.handles.values())
+            self.handles.clear()
+        for file_obj in handles:
+            self.fs.close(file_obj)
+
+    def file_task(self, label, name, mode, action, done, writer=True):
+        # Runs action(file_obj) on a worker with the open handle for name in mode;
+        # done receives action's result, or the open error is reported
+        def work():
+            file_obj, result = self.handle_for(name, mode)
+            if not file_obj:
+                return False, result
+            return True, action(file_obj)
+
+        def finish(outcome):
+            opened, result = outcome
+            if opened:
+                done(result)
+            else:
+                self.output_text.insert(tk.END, result + "\n")
+                self.update_status("Error: Could not open file")
+                messagebox.showerror("Error", result)
+
+        self.run_task(label, work, finish, writer=writer)
+
     def write_file(self):
         # Get input values
         name = self.file_name_entry.get()
@@ -633,165 +3507,266 @@ class FileSystemGUI:
             messagebox.showerror("Error", "Invalid mode selected for writing")
             return
 
-        # Open file in specified mode (creates file if it doesn't exist)
-        file_obj, result = self.fs.open(name, mode)
-        if file_obj:
-            try:
-                write_at = self.write_at.get()
-                if write_at:
-                    result = file_obj.write_to_file(text, int(write_at))  # Write at specific position
-                else:
-                    result = file_obj.write_to_file(text)  # Write based on mode (w: overwrite, a: append)
-                self.output_text.insert(tk.END, result + "\n")
-                self.fs.close(name)
-                self.update_status("Text written to file successfully")
-                messagebox.showinfo("Success", result)
-            except ValueError:
-                self.update_status("Error: Position must be a number")
-                messagebox.showerror("Error", "Position must be a number")
-            except Exception as e:
-                self.update_status(f"Error: {str(e)}")
-                messagebox.showerror("Error", str(e))
-        else:
+        write_at = self.write_at.get()
+        try:
+            write_at = int(write_at) if write_at else None
+        except ValueError:
+            self.update_status("Error: Position must be a number")
+            messagebox.showerror("Error", "Position must be a number")
+            return
+
+        def done(result):
             self.output_text.insert(tk.END, result + "\n")
-            self.update_status("Error: Could not open file")
-            messagebox.showerror("Error", result)
-        
+            self.update_status("Text written to file successfully")
+            messagebox.showinfo("Success", result)
+
+        # Opening in a write mode creates the file if it doesn't exist; without a position
+        # the mode decides (w: overwrite, a: append)
+        self.file_task("Writing", name, mode, lambda file_obj: file_obj.write_to_file(text, write_at), done)
+
     def read_file(self):
         name = self.file_name_entry.get()
         if not name:
             self.update_status("Error: Please enter a file name")
             messagebox.showerror("Error", "Please enter a file name")
             return
-            
-        file_obj, result = self.fs.open(name, "r")
-        if file_obj:
-            try:
-                start = self.read_start.get().strip()
-                size = self.read_size.get().strip()
-                
-                # Convert inputs to integers if provided, else None
-                start_val = int(start) if start else None
-                size_val = int(size) if size else None
-                
-                # Read based on provided parameters
-                content = file_obj.read_from_file(start_val, size_val)
-                
-                # Handle empty or no content
-                if content == "":
-                    content_display = "<No content or read beyond file length>"
-                else:
-                    content_display = content
-                
-                # Show content in popup
-                content_window = tk.Toplevel(self.root)
-                content_window.title(f"Contents of {name}")
-                content_window.geometry("400x300")
-                
-                text_area = tk.Text(
-                    content_window,
-                    wrap=tk.WORD,
-                    font=("Consolas", 10),
-                    bg="#2d2d2d",
-                    fg="#f0f0f0"
-                )
-                text_area.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-                text_area.insert(tk.END, content_display)
-                text_area.config(state='disabled')
-                
-                ttk.Button(
-                    content_window,
-                    text="Close",
-                    command=content_window.destroy
-                ).pack(pady=5)
-                
-                self.fs.close(name)
-                self.output_text.insert(tk.END, f"Read operation completed for {name}\n")
-                self.update_status("File read successfully")
-                messagebox.showinfo("Success", "File read successfully")
-            except ValueError:
-                self.update_status("Error: Start and size must be valid numbers")
-                messagebox.showerror("Error", "Start and size must be valid numbers")
-            except Exception as e:
-                self.update_status(f"Error: {str(e)}")
-                messagebox.showerror("Error", str(e))
-        else:
-            self.output_text.insert(tk.END, result + "\n")
-            self.update_status("Error: Could not open file")
-            messagebox.showerror("Error", result)
-        
+
+        try:
+            # Convert inputs to integers if provided, else None
+            start = self.read_start.get().strip()
+            size = self.read_size.get().strip()
+            start_val = int(start) if start else None
+            size_val = int(size) if size else None
+        except ValueError:
+            self.update_status("Error: Start and size must be valid numbers")
+            messagebox.showerror("Error", "Start and size must be valid numbers")
+            return
+
+        def done(content):
+            # Handle empty or no content
+            if content == "":
+                content_display = "<No content or read beyond file length>"
+            else:
+                content_display = content
+
+            # Show content in popup
+            content_window = tk.Toplevel(self.root)
+            content_window.title(f"Contents of {name}")
+            content_window.geometry("400x300")
+
+            text_area = tk.Text(
+                content_window,
+                wrap=tk.WORD,
+                font=("Consolas", 10),
+                bg="#2d2d2d",
+                fg="#f0f0f0"
+            )
+            text_area.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+            text_area.insert(tk.END, content_display)
+            text_area.config(state='disabled')
+
+            ttk.Button(
+                content_window,
+                text="Close",
+                command=content_window.destroy
+            ).pack(pady=5)
+
+            self.output_text.insert(tk.END, f"Read operation completed for {name}\n")
+            self.update_status("File read successfully")
+            messagebox.showinfo("Success", "File read successfully")
+
+        self.file_task("Reading", name, "r", lambda file_obj: file_obj.read_from_file(start_val, size_val), done)
+
     def move_within_file(self):
         name = self.file_name_entry.get()
         start = self.move_start.get()
         size = self.move_size.get()
         target = self.move_target.get()
-        
+
         if not name or not start or not size or not target:
             self.update_status("Error: Please fill all fields for move operation")
             messagebox.showerror("Error", "Please fill all fields for move operation")
             return
-            
-        file_obj, result = self.fs.open(name, "w")
-        if file_obj:
-            try:
-                result = file_obj.move_within_file(int(start), int(size), int(target))
-                self.output_text.insert(tk.END, result + "\n")
-                self.fs.close(name)
-                self.update_status("Data moved within file successfully")
-                messagebox.showinfo("Success", result)
-            except ValueError:
-                self.update_status("Error: Positions must be numbers")
-                messagebox.showerror("Error", "Positions must be numbers")
-            except Exception as e:
-                self.update_status(f"Error: {str(e)}")
-                messagebox.showerror("Error", str(e))
-        else:
+        try:
+            start, size, target = int(start), int(size), int(target)
+        except ValueError:
+            self.update_status("Error: Positions must be numbers")
+            messagebox.showerror("Error", "Positions must be numbers")
+            return
+
+        def done(result):
             self.output_text.insert(tk.END, result + "\n")
-            self.update_status("Error: Could not open file")
-            messagebox.showerror("Error", result)
-        
+            self.update_status("Data moved within file successfully")
+            messagebox.showinfo("Success", result)
+
+        self.file_task("Moving data", name, "w", lambda file_obj: file_obj.move_within_file(start, size, target), done)
+
     def truncate_file(self):
         name = self.file_name_entry.get()
         size = self.truncate_size.get()
-        
+
         if not name or not size:
             self.update_status("Error: Please enter file name and size")
             messagebox.showerror("Error", "Please enter file name and size")
             return
-            
-        file_obj, result = self.fs.open(name, "w")
-        if file_obj:
-            try:
-                result = file_obj.truncate_file(int(size))
-                self.output_text.insert(tk.END, result + "\n")
-                self.fs.close(name)
-                self.update_status("File truncated successfully")
-                messagebox.showinfo("Success", result)
-            except ValueError:
-                self.update_status("Error: Size must be a number")
-                messagebox.showerror("Error", "Size must be a number")
-            except Exception as e:
-                self.update_status(f"Error: {str(e)}")
-                messagebox.showerror("Error", str(e))
-        else:
+        try:
+            size = int(size)
+        except ValueError:
+            self.update_status("Error: Size must be a number")
+            messagebox.showerror("Error", "Size must be a number")
+            return
+
+        def done(result):
             self.output_text.insert(tk.END, result + "\n")
-            self.update_status("Error: Could not open file")
-            messagebox.showerror("Error", result)
-        
+            self.update_status("File truncated successfully")
+            messagebox.showinfo("Success", result)
+
+        self.file_task("Truncating", name, "w", lambda file_obj: file_obj.truncate_file(size), done)
+
     def show_memory_map(self):
-        result = self.fs.show_memory_map()
-        self.output_text.insert(tk.END, result + "\n")
-        self.update_status("Memory map displayed")
-        messagebox.showinfo("Memory Map", result)
-    
+        def done(result):
+            self.output_text.insert(tk.END, result + "\n")
+            self.update_status("Memory map displayed")
+            messagebox.showinfo("Memory Map", result)
+
+        self.run_task("Building memory map", self.fs.show_memory_map, done, long=True)
+
+    def search_files(self):
+        text = self.search_text.get()
+        if not WORD_RE.search(text):
+            self.update_status("Error: Please enter words to search for")
+            messagebox.showerror("Error", "Please enter words to search for")
+            return
+
+        def done(results):
+            self.output_text.insert(tk.END, f"Search for {text!r}: {len(results)} files\n")
+            for path, offsets in results:
+                self.output_text.insert(tk.END, f"  {path}: offsets {', '.join(map(str, offsets[:20]))}"
+                                        + (" ..." if len(offsets) > 20 else "") + "\n")
+            self.update_status(f"Found {text!r} in {len(results)} files")
+
+        self.run_task("Searching", lambda: self.fs.search(text), done, long=True)
+
     def list_directory(self):
         name = self.name_entry.get() or None
-        result = self.fs.list_dir(name)
-        self.output_text.insert(tk.END, result + "\n")
-        self.update_status("Directory contents listed")
-        messagebox.showinfo("Directory Contents", result)
+        full_path = self.fs.get_full_path(name or self.fs.current_dir)
+
+        def done(exists):
+            if not exists:
+                self.update_status("Error: Directory does not exist")
+                messagebox.showerror("Error", "Directory does not exist")
+                return
+            self.listing.delete(*self.listing.get_children())
+            self.listing_path = full_path
+            self.listing_rows = []
+            self.listing_at_start = True
+            self.listing_done = False
+            self.listing_loading = False
+            self.load_listing_page()
+            self.notebook.select(self.listing_tab)
+
+        self.run_task("Listing", lambda: self.fs.is_dir(full_path), done)
+
+    def load_listing_page(self, backward=False):
+        if self.listing_loading or (self.listing_at_start if backward else self.listing_done):
+            return
+        self.listing_loading = True
+        path, rows, page = self.listing_path, self.listing_rows, self.listing_page_size
+        after = (rows[0] if backward else rows[-1]) if rows else None
+
+        def done(entries):
+            self.listing_loading = False
+            if path != self.listing_path:
+                return  # Another directory was listed meanwhile
+            top = float(self.listing.yview()[0]) * len(rows)  # Row at the top of the view
+            for entry in entries:
+                self.listing.insert("", 0 if backward else tk.END, text=entry.name,
+                                    values=(entry.type.capitalize(), entry.size, format_time(entry.created)))
+            excess = max(0, len(rows) + len(entries) - self.listing_window * page)
+            children = self.listing.get_children()
+            if backward:
+                rows[:0] = entries[::-1]  # A reverse page comes nearest-first
+                self.listing_at_start = len(entries) < page
+                if excess:
+                    self.listing.delete(*children[len(children) - excess:])
+                    del rows[len(rows) - excess:]
+                    self.listing_done = False
+                top += len(entries)
+            else:
+                rows.extend(entries)
+                self.listing_done = len(entries) < page
+                if excess:
+                    self.listing.delete(*children[:excess])
+                    del rows[:excess]
+                    self.listing_at_start = False
+                top -= excess
+            if rows:
+                self.listing.yview_moveto(max(top, 0) / len(rows))  # Keep the same rows in view
+            self.update_status(f"Listing {self.listing_path}: {len(rows)} entries shown"
+                               + ("" if self.listing_done and self.listing_at_start else ", scroll for more"))
+
+        self.run_task("Loading entries", lambda: list(self.fs.scandir(path, reverse=backward, after=after, limit=page)),
+                      done)
+
+    def on_listing_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        if float(last) > 0.9 and not self.listing_done:
+            self.root.after_idle(self.load_listing_page)
+        elif float(first) < 0.1 and not self.listing_at_start:
+            self.root.after_idle(lambda: self.load_listing_page(backward=True))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="oel1", description="File system image tools. Without a command the GUI is started.")
+    parser.add_argument("--image", default="sample.dat", help="image file (default: sample.dat)")
+    parser.add_argument("--format", choices=["json", "binary"],
+                        help="image format for new checkpoints (default: binary)")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="batch mode: commands between journal flushes (default: 1000)")
+    parser.add_argument("command", nargs="?", default="gui",
+                        help="gui, shell (interactive), batch (commands from stdin) or a shell command, e.g. ls /")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments of a shell command")
+    options = parser.parse_args(argv)
+    if options.args and options.command in ("gui", "shell", "batch"):
+        parser.error(f"{options.command} takes no arguments (options go before the command)")
+
+    if options.command == "gui":
+        load_tk()
+        root = tk.Tk()
+        FileSystemGUI(root, FileSystem(options.image, image_format=options.format))
+        root.mainloop()
+        return 0
+
+    batch = options.command == "batch"
+    fs = FileSystem(options.image, image_format=options.format, durability="batch" if batch else "immediate",
+                    batch_size=None)
+    shell = FileSystemShell(fs)
+    try:
+        if options.command == "shell":
+            if not sys.stdin.isatty():
+                shell.prompt = ""
+            shell.cmdloop()
+        elif batch:
+            # Commands run in batches of batch_size, each flushed once as it ends. stdout is only
+            # flushed after the journal, so any result a downstream reader has seen is durable.
+            lines = iter(sys.stdin)
+            done = False
+            while not done:
+                done = True
+                with fs.batch():
+                    for count, line in enumerate(lines, 1):
+                        if shell.onecmd(line.rstrip("\n")):
+                            break
+                        if count == options.batch_size:
+                            done = False
+                            break
+                sys.stdout.flush()
+        else:
+            shell.onecmd(shlex.join([options.command] + options.args))
+    finally:
+        fs.flush()
+        sys.stdout.flush()
+        fs.journal.close()
+    return 1 if shell.failed else 0
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = FileSystemGUI(root)
-    root.mainloop()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,492 @@
+import asyncio
+import fnmatch
+import io
+import os
+import random
+import shutil
+import threading
+import time
+
+import pytest
+
+from oel1 import AsyncFileSystem, FileSystem, Rollback, main
+
+
+def test_rollback_closes_handles_and_keeps_inodes(tmp_path):
+    fs = FileSystem(str(tmp_path / "fs.dat"))
+    with fs.transaction():
+        stale, result = fs.open("/tmpfile", "w")
+        stale.write_to_file("draft")
+        inode = stale.data_id
+        raise Rollback
+    assert stale.fd is None
+    assert fs.open_files == {} and fs.open_counts == {}
+
+    assert fs.create("/secret") == "File /secret created"
+    assert fs.fs_structure["/"].contents["secret"].inode != inode
+    secret, result = fs.open("/secret", "w")
+    secret.write_to_file("classified")
+
+    assert stale.read_from_file() == ""
+    assert stale.write_to_file("overwrite") == "File does not exist"
+    assert stale.truncate_file(0) == "File does not exist"
+    assert fs.open("/secret", "r")[0].read_from_file() == "classified"
+    assert FileSystem(str(tmp_path / "fs.dat")).open("/secret", "r")[0].read_from_file() == "classified"
+
+
+def test_scandir_pages_survive_reverse_and_deleted_cursor(tmp_path):
+    fs = FileSystem(str(tmp_path / "fs.dat"))
+    for sort in (None, "size", "created"):
+        fs.mkdir("/d")
+        for name in "abcde":
+            fs.open("/d/" + name, "w")[0].write_to_file(name * (ord(name) - 96))
+        first = list(fs.scandir("/d", sort=sort, reverse=True, limit=2))
+        assert [e.name for e in first] == ["e", "d"]
+        assert [e.name for e in fs.scandir("/d", sort=sort, reverse=True, after=first[-1], limit=2)] == ["c", "b"]
+        page = list(fs.scandir("/d", sort=sort, limit=2))
+        assert [e.name for e in page] == ["a", "b"]
+        fs.delete("/d/b")
+        assert [e.name for e in fs.scandir("/d", sort=sort, after=page[-1], limit=2)] == ["c", "d"]
+        fs.rmtree("/d")
+
+
+def test_block_owner_follows_shared_blocks(tmp_path):
+    fs = FileSystem(str(tmp_path / "fs.dat"), block_size=4, dedup=True)
+    fs.open("/a", "w")[0].write_to_file("abcdabcd")
+    fs.open("/b", "w")[0].write_to_file("abcd")
+    fs.copy_tree("/a", "/c")
+    block = fs.memory_map.files[fs.fs_structure["/"].contents["b"].inode][0]
+    assert fs.block_owner(block) == "/a"
+    fs.delete("/a")
+    assert fs.block_owner(block) in ("/b", "/c")
+    fs.delete("/b")
+    assert fs.block_owner(block) == "/c"
+    fs.delete("/c")
+    assert fs.block_owner(block) is None
+
+
+def test_search_indexes_appends_and_rejects_wordless_text(tmp_path):
+    fs = FileSystem(str(tmp_path / "fs.dat"))
+    with pytest.raises(ValueError):
+        fs.search(" ... ")
+    handle, result = fs.open("/log", "a")
+    handle.write_to_file("héllo wörld " * 20000)
+    assert fs.search("HÉLLO wörld")[0][1][:2] == [0, 12]
+    handle.write_to_file("zebra")
+    assert fs.search("wörld zebra") == [("/log", [len("héllo wörld " * 20000) - 6])]
+    assert fs.search("zebra") == [("/log", [len("héllo wörld " * 20000)])]
+    fs.close(handle)
+    for _ in range(100):
+        with fs.text_index.cond:
+            if not fs.text_index.pending and fs.text_index.indexing is None:
+                break
+        time.sleep(0.01)
+    assert fs.text_index.postings["zebra"] == {handle.data_id}
+
+
+def test_text_offsets_on_non_ascii_files_span_blocks(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, block_size=5, image_format="binary", compression="zlib", compress_threshold=5)
+    text = "añb日c\U0001F600d" * 20
+    handle, result = fs.open("/t", "w")
+    handle.write_to_file(text)
+    assert handle.read_from_file(13, 9) == text[13:22]
+    handle.write_to_file("XY", 30)
+    text = text[:30] + "XY" + text[32:]
+    handle.move_within_file(3, 4, 50)
+    rest = text[:3] + text[7:]
+    text = rest[:50] + text[3:7] + rest[50:]
+    fs.checkpoint()
+
+    reloaded = FileSystem(path, block_size=5, compression="zlib", compress_threshold=5)
+    handle, result = reloaded.open("/t", "w")
+    assert handle.read_from_file(41, 17) == text[41:58]
+    handle.truncate_file(77)
+    assert handle.read_from_file() == text[:77]
+    assert handle.read_from_file(70, 100) == text[70:77]
+
+
+def test_background_checkpoint_writes_the_state_it_captured(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, image_format="binary", block_size=8)
+    fs.mkdir("/d")
+    fs.open("/d/a", "w")[0].write_to_file("one two three")
+    fs.open("/d/b", "w")[0].write_to_file("déjà vu")
+    fs.mkdir("/e")
+    fs.checkpoint()
+    fs = FileSystem(path, block_size=8)  # Content is served from the image again
+
+    gate = threading.Event()
+    write_snapshot = fs.write_snapshot
+    fs.write_snapshot = lambda snapshot: gate.wait() and write_snapshot(snapshot)
+    assert fs.checkpoint(background=True) == "Checkpoint started"
+    fs.open("/d/a", "a")[0].write_to_file(" four")
+    fs.copy_tree("/d", "/c")
+    fs.open("/c/b", "w")[0].write_to_file("déjà", 2)
+    fs.delete("/d/b")
+    fs.move("/d", "/e/d")
+    fs.set_quota("/e", 1000, None)
+    fs.create("/new")
+    gate.set()
+    fs.snapshot_thread.join()
+
+    shutil.copy(path, str(tmp_path / "image.dat"))
+    captured = FileSystem(str(tmp_path / "image.dat"))
+    assert sorted(captured.fs_structure["/"].contents) == ["d", "e"]
+    assert captured.open("/d/a", "r")[0].read_from_file() == "one two three"
+    assert captured.open("/d/b", "r")[0].read_from_file(2, 3) == "jà "
+    assert captured.fs_structure["/"].contents["e"].quota is None
+
+    reloaded = FileSystem(path)
+    assert sorted(reloaded.fs_structure["/"].contents) == ["c", "e", "new"]
+    assert reloaded.open("/e/d/a", "r")[0].read_from_file() == "one two three four"
+    assert reloaded.open("/c/b", "r")[0].read_from_file() == "dédéjàu"
+    assert reloaded.fs_structure["/"].contents["e"].quota == [1000, None]
+
+
+def test_rollback_waits_for_a_background_checkpoint(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, image_format="binary")
+    fs.open("/a", "w")[0].write_to_file("hello")
+    fs.checkpoint()
+    fs = FileSystem(path)
+    gate = threading.Event()
+    write_snapshot = fs.write_snapshot
+    fs.write_snapshot = lambda snapshot: gate.wait() and write_snapshot(snapshot)
+    batch = fs.batch
+
+    def batch_starting_checkpoint():
+        # Another thread's checkpoint starts just as the transaction is about to begin
+        fs.checkpoint(background=True)
+        threading.Timer(0.1, gate.set).start()
+        return batch()
+
+    fs.batch = batch_starting_checkpoint
+    with fs.transaction():
+        fs.create("/x")
+        raise Rollback
+    if fs.snapshot_thread is not None:
+        fs.snapshot_thread.join()
+    assert fs.open("/a", "r")[0].read_from_file() == "hello"
+    assert "/x" not in fs.list_dir("/")
+    assert FileSystem(path).open("/a", "r")[0].read_from_file() == "hello"
+
+
+def test_checkpoint_inside_a_transaction_is_deferred(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    with fs.transaction():
+        fs.create("/x")
+        assert fs.checkpoint() == "Checkpoint deferred until the transaction ends"
+        raise Rollback
+    assert fs.open("/x", "r")[0] is None
+    assert FileSystem(path).open("/x", "r")[0] is None
+
+
+def test_failed_nested_block_only_undoes_its_own_work(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    with fs.transaction():
+        fs.mkdir("/d")
+        fs.open("/d/a", "w")[0].write_to_file("kept")
+        try:
+            with fs.transaction():
+                fs.create("/d/b")
+                raise ValueError("inner")
+        except ValueError:
+            pass
+        fs.create("/d/c")
+    for reloaded in (fs, FileSystem(path)):
+        assert sorted(reloaded.fs_structure["/"].contents["d"].contents) == ["a", "c"]
+        assert reloaded.open("/d/a", "r")[0].read_from_file() == "kept"
+
+
+def test_another_threads_batch_does_not_hold_back_immediate_writes(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    paused, resume = threading.Event(), threading.Event()
+
+    def chunks():
+        yield "bulk"
+        paused.set()
+        resume.wait()
+        yield "more"
+
+    writer = threading.Thread(target=fs.open("/bulk", "w")[0].write_stream, args=(chunks(),))
+    writer.start()
+    paused.wait()
+    try:
+        handle = fs.open("/other", "w")[0]
+        assert handle.write_to_file("important") == "Write successful"
+        fs.close("/other")
+        with open(path + ".journal", "rb") as journal:
+            assert b"important" in journal.read()
+    finally:
+        resume.set()
+        writer.join()
+    assert FileSystem(path).open("/bulk", "r")[0].read_from_file() == "bulkmore"
+
+
+def test_binary_writes_accept_bytes_like_data(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, compression=None)
+    data = bytearray(b"\x00\xffabc")
+    handle = fs.open("/a", "wb")[0]
+    assert handle.write_to_file(data) == "Write successful"
+    data[0] = 1
+    assert handle.write_to_file(42) == "Invalid data type"
+    assert fs.open("/b", "w")[0].write_to_file(b"text") == "Invalid data type"
+    assert fs.open("/a", "rb")[0].read_from_file() == b"\x00\xffabc"
+    assert fs.open("/c", "wb")[0].write_stream([bytearray(b"de"), memoryview(b"fg")]) == "Write successful"
+    assert fs.open("/c", "rb")[0].read_from_file() == b"defg"
+    assert fs.apply([("write", "/d", bytearray(b"xy"))]) == ["Write successful"]
+    assert "Memory Map" in fs.show_memory_map()
+    fs.checkpoint()
+    assert FileSystem(path).open("/c", "rb")[0].read_from_file() == b"defg"
+
+
+def test_star_import_exports_only_public_names():
+    namespace = {"asyncio": asyncio}
+    exec("from oel1 import *", namespace)
+    assert namespace["asyncio"] is asyncio
+    assert "FileSystem" in namespace and "tk" not in namespace
+
+
+def test_async_facade_works_without_prior_construction(tmp_path):
+    async def run():
+        afs = AsyncFileSystem(data_file=str(tmp_path / "fs.dat"))
+        handle, _ = await afs.open("/a", "w")
+        assert await handle.write_to_file("hi") == "Write successful"
+        await afs.flush()
+        return await handle.read_from_file()
+
+    assert asyncio.run(run()) == "hi"
+
+
+def test_concurrent_mutations_match_models_and_reload(tmp_path, monkeypatch):
+    # A small bench.py stress run: threads create/append/move alongside background checkpoints
+    # and flushes, then the live tree and a fresh load must both match the per-thread models
+    def contents(fs):
+        state = {}
+        for path, dirnames, filenames in fs.walk("/"):
+            for name in filenames:
+                full = f"{path.rstrip('/')}/{name}"
+                handle, _ = fs.open(full, "rb")
+                state[full] = handle.read_from_file()
+                fs.close(handle)
+        return state
+
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, journal_limit=16 << 10, durability="interval", flush_interval=5)
+    fs.mkdir("/shared")
+    models = [{} for _ in range(4)]
+    errors = []
+    monkeypatch.setattr(threading, "excepthook", lambda args: errors.append(repr(args.exc_value)))
+
+    def worker(t):
+        rng = random.Random(t)
+        model = models[t]
+        home = f"/t{t}"
+        fs.mkdir(home)
+        try:
+            for i in range(300):
+                roll = rng.random()
+                if roll < 0.2 or not model:
+                    target = f"{home}/f{i}"
+                    assert fs.create(target) == f"File {target} created"
+                    model[target] = b""
+                elif roll < 0.7:
+                    target = rng.choice(list(model))
+                    data = f"{t}:{i};".encode() * rng.randint(1, 50)
+                    handle, _ = fs.open(target, "ab")
+                    assert handle.write_to_file(data) == "Write successful"
+                    fs.close(handle)
+                    model[target] += data
+                elif roll < 0.85:
+                    source = rng.choice(list(model))
+                    target = f"/shared/t{t}-{i}" if rng.random() < 0.5 else f"{home}/m{i}"
+                    assert fs.move(source, target) == f"Moved {source} to {target}"
+                    model[target] = model.pop(source)
+                elif roll < 0.9:
+                    fs.checkpoint(background=True)
+                else:
+                    fs.flush()
+                if i % 50 == 0:
+                    target = rng.choice(list(model))
+                    handle, _ = fs.open(target, "rb")
+                    assert handle.read_from_file() == model[target]
+                    fs.close(handle)
+        except Exception as exc:
+            errors.append(f"thread {t}: {exc!r}")
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(4)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if fs.snapshot_thread is not None:
+        fs.snapshot_thread.join()
+    fs.flush()
+    assert errors == []
+    expected = {name: data for model in models for name, data in model.items()}
+    assert contents(fs) == expected
+    fs.journal.close()
+    assert contents(FileSystem(path)) == expected
+
+
+def test_images_default_to_binary_and_keep_raw_bytes(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    data = os.urandom(256 << 10)
+    fs = FileSystem(path, image_format="json")
+    fs.open("/old", "wb")[0].write_to_file(b"\xff\xfe")
+    fs.checkpoint()
+    assert not FileSystem(path).is_binary_image()
+    fs = FileSystem(path)
+    fs.open("/a", "wb")[0].write_to_file(data)
+    fs.checkpoint()
+    assert fs.is_binary_image()
+    assert os.path.getsize(path) < len(data) * 1.01
+    reloaded = FileSystem(path)
+    assert reloaded.open("/a", "rb")[0].read_from_file() == data
+    assert reloaded.open("/old", "rb")[0].read_from_file() == b"\xff\xfe"
+
+
+def test_journal_replay_drops_a_torn_tail_record(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    fs.mkdir("/d")
+    fs.open("/d/a", "w")[0].write_to_file("first")
+    fs.journal.close()
+    with open(path + ".journal", "ab") as journal:
+        journal.write(b'{"op":"bwrite","id":2,"at":0,"len":9,"seq":9}\nhalf')
+    fs = FileSystem(path)
+    assert fs.open("/d/a", "r")[0].read_from_file() == "first"
+    fs.open("/d/a", "a")[0].write_to_file(" second")
+    fs.journal.close()
+    assert FileSystem(path).open("/d/a", "r")[0].read_from_file() == "first second"
+
+
+def test_journal_replay_after_a_checkpoint(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    fs.open("/a", "w")[0].write_to_file("before")
+    fs.checkpoint()
+    fs.open("/a", "a")[0].write_to_file(" after")
+    fs.move("/a", "/b")
+    fs.journal.rotate()  # A checkpoint that set the journal aside but never installed its image
+    fs.create("/c")
+    fs.journal.close()
+    reloaded = FileSystem(path)
+    assert reloaded.open("/b", "r")[0].read_from_file() == "before after"
+    assert sorted(reloaded.fs_structure["/"].contents) == ["b", "c"]
+
+
+def test_quota_and_capacity_errors(tmp_path):
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path, capacity=30)
+    fs.mkdir("/q")
+    assert fs.set_quota("/q", 10, 2) == "Quota on /q updated"
+    assert fs.create("/q/a") == "File /q/a created"
+    assert fs.mkdir("/q/d") == "Directory /q/d created"
+    assert fs.create("/q/b") == "Inode quota exceeded for /q"
+    assert fs.mkdir("/q/e") == "Inode quota exceeded for /q"
+    assert fs.open("/q/a", "w")[0].write_to_file("x" * 11) == "Byte quota exceeded for /q"
+    assert fs.open("/q/a", "w")[0].write_to_file("x" * 10) == "Write successful"
+    fs.open("/big", "w")[0].write_to_file("y" * 20)
+    fs.create("/s")
+    assert fs.move("/big", "/q/d/big") == "Byte quota exceeded for /q"
+    assert fs.move("/s", "/q/d/s") == "Inode quota exceeded for /q"
+    assert fs.move("/q/a", "/q/d/a") == "Moved /q/a to /q/d/a"
+    assert fs.open("/big", "a")[0].write_to_file("z") == "Capacity limit reached"
+    assert fs.copy_tree("/q", "/q2") == "Capacity limit reached"
+    for reloaded in (fs, FileSystem(path, capacity=30)):
+        assert sorted(reloaded.fs_structure["/"].contents) == ["big", "q", "s"]
+        assert reloaded.fs_structure["/"].total_bytes == 30
+
+
+def test_find_and_glob_match_a_tree_walk(tmp_path):
+    fs = FileSystem(str(tmp_path / "fs.dat"))
+    rng = random.Random(0)
+    dirs = ["/"]
+    for i in range(300):
+        parent = rng.choice(dirs)
+        name = rng.choice(["log", "data", "app", "a"]) + rng.choice(["", str(i % 7)]) + rng.choice(["", ".log", ".txt"])
+        target = parent.rstrip("/") + "/" + name
+        if rng.random() < 0.3:
+            if fs.mkdir(target).startswith("Directory"):
+                dirs.append(target)
+        else:
+            fs.create(target)
+    removed = next(d for d in reversed(dirs) if not d.startswith(dirs[1] + "/"))
+    assert fs.rmtree(removed) == f"Directory {removed} removed"
+    assert fs.move(dirs[1], "/moved") == f"Moved {dirs[1]} to /moved"
+
+    def walk():
+        for path, dirnames, filenames in fs.walk("/"):
+            for name in dirnames + filenames:
+                yield path.rstrip("/") + "/" + name
+
+    paths = list(walk())
+    for pattern in ["log", "a*", "*.log", "data?.txt", "[la]*", "*"]:
+        expected = sorted(p for p in paths if fnmatch.fnmatchcase(p.rsplit("/", 1)[1], pattern))
+        assert expected and fs.find(pattern) == expected
+        assert fs.find(pattern, "/moved") == [p for p in expected if p.startswith("/moved/")]
+    for pattern in ["/*/*.log", "/moved/*", "/*/log?.*", "/**/*.txt", "/moved/**"]:
+        if "**" in pattern:
+            prefix, suffix = pattern.split("**", 1)
+            expected = [p for p in paths if p.startswith(prefix)
+                        and fnmatch.fnmatchcase(p.rsplit("/", 1)[1], suffix.lstrip("/") or "*")]
+        else:
+            parts = pattern.split("/")
+            expected = [p for p in paths if len(p.split("/")) == len(parts)
+                        and all(fnmatch.fnmatchcase(a, b) for a, b in zip(p.split("/"), parts))]
+        assert expected and fs.glob(pattern) == sorted(expected)
+
+
+def test_cli_one_shot_and_batch_runs(tmp_path, capsys, monkeypatch):
+    image = str(tmp_path / "fs.dat")
+    assert main(["--image", image, "mkdir", "/d"]) == 0
+    assert capsys.readouterr().out == "Directory /d created\n"
+    assert main(["--image", image, "bogus"]) == 1
+    assert capsys.readouterr().out == "Unknown command: bogus\n"
+    monkeypatch.setattr("sys.stdin", io.StringIO('write /d/a "hello world"\ncat /d/a\nrm /nope\ntouch /d/b\n'))
+    assert main(["--image", image, "--batch-size", "2", "batch"]) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        "Write successful", "hello world", "File/directory does not exist", "File /d/b created"]
+    monkeypatch.setattr("sys.stdin", io.StringIO("cat /d/a\nexit\ncat /d/missing\n"))
+    assert main(["--image", image, "batch"]) == 0
+    assert capsys.readouterr().out == "hello world\n"
+    assert main(["--image", image, "find", "b"]) == 0
+    assert capsys.readouterr().out == "/d/b\n"
+
+
+def test_import_and_export_round_trip(tmp_path):
+    def host_tree(root):
+        tree = {}
+        for path, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(path, root)
+            tree[rel] = None
+            for name in filenames:
+                with open(os.path.join(path, name), "rb") as f:
+                    tree[os.path.join(rel, name)] = f.read()
+        return tree
+
+    source = tmp_path / "src"
+    (source / "a" / "b").mkdir(parents=True)
+    (source / "empty").mkdir()
+    (source / "a" / "x.txt").write_text("héllo\n")
+    (source / "a" / "b" / "big.bin").write_bytes(os.urandom(300000))
+    (source / "top").write_bytes(b"")
+    path = str(tmp_path / "fs.dat")
+    fs = FileSystem(path)
+    assert fs.import_tree(str(source), "/in", chunk_size=1 << 16) == (
+        "Imported 3 files, 4 directories (300007 bytes) to /in")
+    (source / "a" / "x.txt").write_text("changed")
+    assert fs.import_tree(str(source / "a"), "/in/a").startswith("Imported 2 files")
+    fs.journal.close()
+    out = tmp_path / "out"
+    assert FileSystem(path).export_tree("/in", str(out), chunk_size=1 << 16) == (
+        f"Exported 3 files, 4 directories (300007 bytes) to {out}")
+    assert host_tree(out) == host_tree(source)
+    assert fs.import_tree(str(tmp_path / "missing"), "/x") == "Host path does not exist"
+    assert fs.export_tree("/missing", str(tmp_path / "x")) == "File/directory does not exist"